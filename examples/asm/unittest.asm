@@ -1,6 +1,6 @@
 ; Unit tests for 16-bit ENG1448 processor
 ; When successful, halts at instruction 4094, showing 0b01010101
-; When unsuccessful, halts at instruction 4095, showing test number (1-31)
+; When unsuccessful, halts at instruction 4095, showing test number (1-37)
 
        .macro setled
        mov  r12, 0x05
@@ -331,11 +331,85 @@ bcc1:  setled 31
        jmp  @err
 bcc2:  shft r0, r1, 1
        bcc  @bcc3
-       b    @done
+       b    @rel1
 bcc3:  jmp  @err
 
+; Unconditional branch out of range, relaxed to jump
+rel1:  setled 32
+       b    @far1
+       jmp  @err
+
+; Conditional branch out of range, relaxed to inverse branch over jump
+rel2:  setled 33
+       mov  r0, 0
+       mov  r0, r0
+       bz   @far2
+       jmp  @err
+rel3:  mov  r0, 1
+       mov  r0, r0
+       bz   @far3
+       b    @ldi1
+
+; Constant load that fits a single mov
+ldi1:  setled 34
+ld1a:  ldi  r1, 200
+ld1b:  mov  r2, 200
+       sub  r0, r1, r2
+       bz   @ldi1s
+       jmp  @err
+ldi1s: mov  r1, low(@ld1a)
+       mov  r2, low(@ld1b)
+       sub  r1, r2, r1
+       mov  r3, 255
+       and  r1, r1, r3
+       sub  r0, r1, 1
+       bz   @ldi2
+       jmp  @err
+
+; 16-bit constant load, expanded to mov and movt
+ldi2:  setled 35
+ld2a:  ldi  r1, @const1
+ld2b:  mov  r2, low(@const1)
+       movt r2, high(@const1)
+       sub  r0, r1, r2
+       bz   @ldi2s
+       jmp  @err
+ldi2s: mov  r1, low(@ld2a)
+       mov  r2, low(@ld2b)
+       sub  r1, r2, r1
+       mov  r3, 255
+       and  r1, r1, r3
+       sub  r0, r1, 2
+       bz   @ldi3
+       jmp  @err
+
+; Constant load of a forward label
+ldi3:  setled 36
+       ldi  r1, @ldfwd
+       mov  r2, low(@ldfwd)
+       movt r2, high(@ldfwd)
+       sub  r0, r1, r2
+       bz   @ldi4
+       jmp  @err
+
+; Negative constant load
+ldi4:  setled 37
+       ldi  r1, -2
+       mov  r2, low(-2)
+       movt r2, high(-2)
+       sub  r0, r1, r2
+       bz   @done
+ldfwd: jmp  @err
+
 done:  jmp  @succ
 
+       .org 0xF00
+
+; Targets of relaxed branches
+far1:  jmp  @rel2
+far2:  jmp  @rel3
+far3:  jmp  @err
+
        .org 0xFEB
 
 succ:  setled 0x55
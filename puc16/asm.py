@@ -4,59 +4,126 @@
    (c) 2020-2025 Wouter Caarls, PUC-Rio
 """
 
-import sys, argparse
+import os, sys, argparse
 
-from .assembler import Preprocessor, Assembler
-from .simulator import Simulator
-from .emitter import emitvhdl
+from .assembler import Preprocessor, Assembler, Object, Linker
+from .simulator import simulate
+from .image import imageformat, load as loadimage
+from .emitter import emitters, emitmap, emitdeps
 
 def main():
     parser = argparse.ArgumentParser(description='PUC16 Assembler (c) 2020-2025 Wouter Caarls, PUC-Rio')
     parser.add_argument('file', type=str,
-                        help='ASM source file')
+                        help='ASM source file, object file (.o) or memory image (.bin, .hex, .vhd, .coe, .mif, .mem)')
+    parser.add_argument('objects', metavar='FILE', type=str, nargs='*',
+                        help='Further ASM source or object files to link')
     parser.add_argument('-o', '--output', type=str,
                         help='Output file', default='-')
+    parser.add_argument('-f', '--format', metavar='FMT', type=str, choices=list(emitters),
+                        help='Memory image format: ' + ', '.join(emitters) + ' (default: from output file extension, or vhdl)')
+    parser.add_argument('-c', action='store_true',
+                        help='Output relocatable object instead of memory image')
     parser.add_argument('-s', '--simulate', action='store_true',
                         help='Simulate resulting program')
     parser.add_argument('-v', '--vga', action='store_true',
                         help='Visualize VGA output during simulation')
     parser.add_argument('-t', '--test', metavar='N', type=int,
                         help='Simulate for 1000 steps and check whether PC == N')
+    parser.add_argument('-p', '--profile', action='store_true',
+                        help='Report memory usage after simulation')
+    parser.add_argument('--record', metavar='FILE', type=str,
+                        help='Record I/O reads during simulation')
+    parser.add_argument('--replay', metavar='FILE', type=str,
+                        help='Replay I/O reads recorded with --record')
+    parser.add_argument('--save-state', metavar='FILE', type=str,
+                        help='Save simulator state after simulation')
+    parser.add_argument('--load-state', metavar='FILE', type=str,
+                        help='Resume simulation from saved state')
+    parser.add_argument('--map', metavar='FILE', type=str,
+                        help='Write label addresses and section usage to FILE')
+    parser.add_argument('-MD', action='store_true',
+                        help='Write a Makefile dependency file for the output')
+    parser.add_argument('-MF', metavar='FILE', type=str,
+                        help='Dependency file (default: output with .d extension)')
+    parser.add_argument('--short-jumps', action='store_true',
+                        help='Replace jumps by branches where in range')
+    parser.add_argument('--cache', metavar='DIR', type=str,
+                        help='Cache preprocessed files in DIR')
     parser.add_argument('-E', action='store_true',
                         help='Output preprocessed assembly code')
 
     args = parser.parse_args()
+    if args.MF is not None:
+        args.MD = True
+    if args.MD and args.output == '-':
+        parser.error('-MD requires -o')
+    if args.format is None:
+        args.format = imageformat(args.output) or 'vhdl'
 
-    pp  = Preprocessor()
-    asm = pp.process(args.file)
+    files = [args.file] + args.objects
+    link = len(files) > 1 or args.file.endswith('.o')
+    if link and (args.c or args.E):
+        parser.error('-c and -E require a single ASM source file')
 
+    if imageformat(args.file) is not None:
+        # Simulate prebuilt memory image
+        if not args.simulate and args.test is None:
+            parser.error('memory images can only be simulated')
+        simulate(args, loadimage(args.file), None)
+        return
+
+    pp  = Preprocessor(args.cache)
+
+    binary = args.format == 'raw' and not args.E and not args.c
     if args.output != '-':
-        f = open(args.output, 'w')
+        f = open(args.output, 'wb' if binary else 'w')
     else:
-        f = sys.stdout
+        f = sys.stdout.buffer if binary else sys.stdout
 
     if args.E:
         # Don't emit machine code, just preprocessed assembly.
-        for (idx, label, inst) in asm:
+        for (idx, label, inst) in pp.process(args.file):
             print(idx + ' ' + (label + ': ' if label != '' else '') + inst, file=f)
+    elif args.c:
+        # Don't link, just output relocatable object.
+        ass = Assembler(args.short_jumps, True)
+        mem = ass.process(pp.stream(args.file), {'io': 0, 'code': 0, 'data': 0})
+        Object(mem, ass.meta, ass.labels, ass.sections, ass.relocations, args.file, ass.exports).save(f)
     else:
-        ass = Assembler()
         origin = {'io': 0, 'code': 16, 'data': 4096}
-        mem = ass.process(asm, origin)
+        if link:
+            objects = []
+            deps = []
+            for file in files:
+                if file.endswith('.o'):
+                    objects.append(Object.load(file))
+                    deps.append(file)
+                else:
+                    ass = Assembler(args.short_jumps, True)
+                    mem = ass.process(pp.stream(file), origin)
+                    objects.append(Object(mem, ass.meta, ass.labels, ass.sections, ass.relocations, file, ass.exports))
+                    deps.extend([file for file, _ in pp.files])
+            ass = Linker(args.short_jumps)
+            mem = ass.process(objects, origin)
+        else:
+            ass = Assembler(args.short_jumps)
+            mem = ass.process(pp.stream(args.file), origin)
+
+        if args.map:
+            with open(args.map, 'w') as m:
+                emitmap(mem, m, origin, ass.labels, ass.sections, ass.meta)
 
         if args.simulate or args.test:
-            sim = Simulator()
-            if args.simulate:
-                sim.process(mem, origin, args.vga)
-            else:
-                pc = sim.run(mem, origin, 1000)
-                if pc != args.test:
-                    raise RuntimeError('PC after 1000 steps is ' + str(pc) + ', expected ' + str(args.test))
+            simulate(args, mem, origin)
         else:
-            emitvhdl(mem, f, origin)
+            emitters[args.format](mem, f, origin, ass.meta)
 
     if args.output != '-':
         f.close()
 
+    if args.MD:
+        with open(args.MF or os.path.splitext(args.output)[0] + '.d', 'w') as d:
+            emitdeps(args.output, deps if link else [file for file, _ in pp.files], d)
+
 if __name__ == '__main__':
     main()
@@ -2,9 +2,12 @@
 (c) 2020-2024 Wouter Caarls, PUC-Rio
 """
 
-import sys, os, string, math, re
+import sys, os, io, string, math, re, array, itertools, hashlib, marshal, json
 from .instructions import defs
 
+# Field width of each operand type.
+widths = {'R': 4, 'A': 4, '4': 4, '8': 8, '2': 12, '6': 16, 'S': 4, 'B': 8}
+
 def _split(s, delim=r'\s'):
     """https://stackoverflow.com/questions/16710076/python-split-a-string-respect-and-preserve-quotes"""
     return re.findall('(?:[^' + delim + r'"]|"(?:\\.|[^"])*")+', s)
@@ -37,21 +40,150 @@ def split(s):
             operands[i] = '[r13]'
     return mnemonic, operands
 
+def kind(o):
+    """Classifies an operand as register (r), indirect (a), immediate (i),
+    label (l), string (s) or other (x)."""
+    c = o[0]
+    if c == 'r' and o[1:].isdigit():
+        return 'r'
+    elif c == '[':
+        return 'a'
+    elif c == '"':
+        return 's'
+    elif c == '@' or o.startswith('low(') or o.startswith('high('):
+        return 'l'
+    elif c.isdigit() or c == '-' or c == '+':
+        return 'i'
+    else:
+        return 'x'
+
+# Operand kinds accepted by each operand type.
+accepts = {'R': 'r', 'A': 'a', '4': 'il', '8': 'ils', '2': 'il', '6': 'ils',
+           'S': 'il', 'B': 'il', 'X': 'railsx'}
+
+def _signatures():
+    """Maps (mnemonic, operand kinds) to the first applicable encoding."""
+    table = {}
+    for mnemonic in defs:
+        for encoding in defs[mnemonic]:
+            for kinds in itertools.product(*[accepts[r] for r in encoding[2]]):
+                table.setdefault((mnemonic, ''.join(kinds)), encoding)
+    return table
+
+signatures = _signatures()
+
+def normalize(line):
+    """Strips comments and lowers uppercase characters."""
+    c = line.find(';')
+    if c >= 0:
+        line = line[:c]
+    line = line.strip()
+    return ' '.join([t.lower() if t[0] != '"' else t for t in _split(line)])
+
+def refs(operands):
+    """Returns the labels that instruction operands refer to."""
+    names = []
+    for o in operands:
+        if o.startswith('low(') or o.startswith('high('):
+            o = o[o.index('(')+1:-1]
+        if len(o) > 1 and o[0] == '@':
+            names.append(o[1:])
+    return names
+
+def location(idx):
+    """Splits a line index into the file and the line number."""
+    file, _, line = idx.rpartition(':')
+    return file.strip(), int(line)
+
+def diagnostic(file, line, e):
+    """Describes an error as a (file, line, message) tuple. The message
+    does not repeat the location."""
+    if isinstance(e, (SyntaxError, ValueError)):
+        return (file, line, str(e).removeprefix(f'{file}:{line}: '))
+    else:
+        return (file, line, f'{type(e).__name__}: {e}')
+
+class Stream:
+    """Preprocessed source that is read line by line on every iteration."""
+    def __init__(self, preprocessor, file):
+        if not isinstance(file, str):
+            # Non-path sources can only be read once.
+            file = io.StringIO(file.read())
+        self.preprocessor = preprocessor
+        self.file = file
+
+    def __iter__(self):
+        self.preprocessor.files = []
+        if not isinstance(self.file, str):
+            self.file.seek(0)
+        for (file, idx, label, inst) in self.preprocessor._preprocess(self.file, {}):
+            yield (f'{file}:{idx}', label, inst)
+
 class Preprocessor:
     """Assembly preprocessor."""
+    def __init__(self, cachedir=None, cachelimit=65536):
+        """Preprocessed files are cached by path and content hash, in memory
+        and, if cachedir is given, on disk. Files that expand to more than
+        cachelimit lines are not cached."""
+        self.cache = {}
+        self.cachedir = cachedir
+        self.cachelimit = cachelimit
+        self.files = []
+        self.errors = None
+
     def process(self, file):
         """Preprocesses the source, resolving .include and .macro directives,
-        and normalizing the instructions."""
-        asm, _ = self._preprocess(file)
-        return self._reindex(asm)
+        and normalizing the instructions. The paths and content hashes of all
+        files read are available in self.files. If self.errors is a list,
+        errors are appended to it as diagnostics and the line is skipped."""
+        self.files = []
+        return self._reindex(list(self._preprocess(file, {})))
+
+    def stream(self, file):
+        """Like process, but returns an iterable that preprocesses the
+        source lazily, without aligning line numbers. Memory use does not
+        depend on the size of the source."""
+        return Stream(self, file)
+
+    def _cachefile(self, key):
+        """Returns the disk cache file for a cache key."""
+        return os.path.join(self.cachedir, hashlib.sha256('\0'.join(key).encode()).hexdigest() + '.cache')
+
+    def _lookup(self, key):
+        """Returns cached (files, asm, macros) for a file, or None if the
+        file or any file it includes changed."""
+        entry = self.cache.get(key)
+        if entry is None and self.cachedir is not None:
+            try:
+                with open(self._cachefile(key), 'rb') as f:
+                    entry = marshal.load(f)
+            except (OSError, EOFError, ValueError, TypeError):
+                return None
+
+        if entry is not None:
+            for file, digest in entry[0][1:]:
+                try:
+                    with open(file, 'rb') as f:
+                        if hashlib.sha256(f.read()).hexdigest() != digest:
+                            return None
+                except OSError:
+                    return None
+            self.cache[key] = entry
+        return entry
+
+    def _store(self, key, entry):
+        """Caches preprocessed file."""
+        self.cache[key] = entry
+        if self.cachedir is not None:
+            os.makedirs(self.cachedir, exist_ok=True)
+            tmp = self._cachefile(key) + f'.{os.getpid()}'
+            with open(tmp, 'wb') as f:
+                marshal.dump(entry, f)
+            os.replace(tmp, self._cachefile(key))
 
     def _normalize(self, line):
         """Strips comments and lowers uppercase characters."""
-        c = line.find(';')
-        if c >= 0:
-            line = line[:c]
-        line = line.strip()
-        return ' '.join([t.lower() if t[0] != '"' else t for t in _split(line)])
+        return normalize(line)
 
     def _splitlabel(self, line):
         """Split a line into a label and an instruction."""
@@ -71,7 +203,7 @@ class Preprocessor:
                 for o in operands:
                     if o[0] == r'"':
                         if len(o) < 3 or o[-1] != r'"':
-                            raise SyntaxError(f'{file}:{idx:3}: Malformed string constant')
+                            raise SyntaxError(f'{file}:{idx}: Malformed string constant')
                         for c in o[1:-1]:
                             code.append((file, idx, tmp, r'.dw "' + c + r'"'))
                             tmp = ''
@@ -85,108 +217,179 @@ class Preprocessor:
 
         return code
 
-    def _preprocess(self, file, macros={}):
-        """Resolves .include and .macro directives, and splits .dw directives into single words."""
-        asm = []
-        macros = macros.copy()
-        macro = ''
-        nonce = 0
+    def _compile(self, body):
+        """Compiles macro body lines into templates for str.format, in which
+        {0}, {1}, etc. are the macro arguments and {n} makes labels local.
+        Returns (file, idx, label, local, template, lo, hi, dw) tuples, where
+        lo and hi are the lowest and highest argument used and dw indicates
+        whether the line may need to be split into single words."""
+        compiled = []
+        for (file, idx, label, inst) in body:
+            template = ''
+            args = []
+            ii = 0
+            while ii < len(inst):
+                if inst[ii] == '$' and ii < len(inst)-1:
+                    # Macro argument
+                    arg = ord(inst[ii+1])-ord('0')
+                    args.append(arg)
+                    template += '{' + str(arg) + '}'
+                    ii += 2
+                elif inst[ii] == '@' and ii < len(inst)-1 and inst[ii+1] == '_':
+                    # Local label use
+                    while ii < len(inst) and not inst[ii].isspace() and inst[ii] != ']' and inst[ii] != ')':
+                        template += inst[ii]
+                        ii += 1
+                    template += '{n}_'
+                elif inst[ii] == '{' or inst[ii] == '}':
+                    template += inst[ii]*2
+                    ii += 1
+                else:
+                    template += inst[ii]
+                    ii += 1
 
+            local = label != '' and label[0] == '_'
+            dw = inst.startswith('.dw') or inst.startswith('$')
+            compiled.append((file, idx, label, local, template, min(args, default=0), max(args, default=-1), dw))
+        return compiled
+
+    def _preprocess(self, file, macros):
+        """Generates preprocessed (file, idx, label, inst) lines, resolving
+        .include and .macro directives, and splitting .dw directives into
+        single words. Macros that are defined are added to macros."""
         if isinstance(file, str):
             dir = os.path.dirname(file)
-            f = open(file, 'r')
+            digest = hashlib.sha256()
+            with open(file, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    digest.update(chunk)
+            key = (file, digest.hexdigest())
+            if not macros:
+                entry = self._lookup(key)
+                if entry is not None:
+                    self.files.extend(entry[0])
+                    macros.update(entry[2])
+                    yield from entry[1]
+                    return
+            cached = [] if not macros else None
+            start = len(self.files)
+            errors = len(self.errors) if self.errors is not None else 0
+            self.files.append(key)
+            with open(file, 'r') as f:
+                yield from self._lines(f, file, dir, macros, cached)
+            if self.errors is not None and len(self.errors) > errors:
+                # Report the errors again when the file is next read
+                cached = None
+            if cached is not None and len(cached) <= self.cachelimit:
+                self._store(key, (self.files[start:], cached, macros))
         else:
-            dir = '.'
-            f = file
-            file = '<stdin>'
+            yield from self._lines(file, '<stdin>', '.', macros, None)
+
+    def _lines(self, f, file, dir, macros, cached):
+        """Preprocesses the lines of an open file. If cached is a list,
+        the output is also recorded into it."""
+        macro = ''
+        nonce = 0
 
-        for idx, line in enumerate(f.readlines()):
+        for idx, line in enumerate(f):
             idx = idx + 1
 
-            if macro == '':
+            emit = macro == ''
+            if emit:
                 # Emit into main instruction stream
-                code = asm
+                code = []
             else:
                 # Currently processing a macro; emit into that.
                 code = macros[macro]
 
-            (label, inst) = self._splitlabel(self._normalize(line))
+            try:
+                (label, inst) = self._splitlabel(self._normalize(line))
 
-            if inst != '':
-                mnemonic, operands = split(inst)
-                if len(operands) > 0:
-                    o = operands[0]
-
-                if mnemonic == '.include':
-                    # Include other assembly file.
-                    if len(operands) != 1:
-                        raise SyntaxError(f'{file}:{idx:3}: Expected string constant')
-                    if len(o) < 3 or (o[0] != '"' and o[0] != '\'') or (o[-1] != '"' and o[-1] != '\''):
-                        raise SyntaxError(f'{file}:{idx:3}: Malformed string constant {o}')
-                    if label != '':
-                        code.append((file, idx, label, ''))
-                    asm2, macros2 = self._preprocess(os.path.join(dir, o[1:-1]))
-                    for line2 in asm2:
-                        code.append(line2)
-                    macros.update(macros2)
-                elif mnemonic == '.dw':
-                    # Split .dw into single-word constants
-                    code.extend(self._splitdw(file, idx, label, inst))
-                elif mnemonic == '.macro':
-                    # Create a new macro.
-                    if len(operands) != 1:
-                        raise SyntaxError(f'{file}:{idx:3}: Missing macro name')
-                    elif macro != '':
-                        raise SyntaxError(f'{file}:{idx:3}: Cannot nest macro definitions')
-                    elif o in defs:
-                        raise SyntaxError(f'{file}:{idx:3}: Macro definition {o} shadows mnemonic')
-                    elif o in macros:
-                        raise SyntaxError(f'{file}:{idx:3}: Redefinition of macro {o}')
-                    macro = o
-                    macros[macro] = []
-                elif mnemonic == '.endmacro':
-                    # Macro finished.
-                    macro = ''
-                elif mnemonic in macros:
-                    # Macro call. Emit macro contents into main instruction stream.
-                    if label != '':
-                        code.append((file, idx, label, ''))
-
-                    for (file2, idx2, label2, inst2) in macros[mnemonic]:
-                        newinst = ''
-                        ii = 0
-                        if label2 != '' and label2[0] == '_':
-                            # Make label definition local
-                            label2 = label2 + str(nonce) + '_'
-                        while ii < len(inst2):
-                            if inst2[ii] == '$' and ii < len(inst2)-1:
-                                # Resolve macro argument
-                                arg = ord(inst2[ii+1])-ord('0');
-                                if arg >= 0 and arg < len(operands):
-                                    newinst = newinst + operands[arg]
-                                    ii += 2
-                                else:
-                                    raise SyntaxError(f'Invalid argument ${arg} in call to macro {mnemonic}')
-                            elif inst2[ii] == '@' and ii < len(inst2)-1 and inst2[ii+1] == '_':
-                                # Make label use local
-                                while ii < len(inst2) and not inst2[ii].isspace() and inst2[ii] != ']' and inst2[ii] != ')':
-                                    newinst = newinst + inst2[ii]
-                                    ii += 1
-                                newinst = newinst + str(nonce) + '_'
-                            else:
-                                newinst = newinst + inst2[ii]
-                                ii += 1
+                if inst != '':
+                    mnemonic, operands = split(inst)
+                    if len(operands) > 0:
+                        o = operands[0]
 
-                        code.extend(self._splitdw(file2, idx2, label2, newinst))
-                    nonce += 1
-                else:
+                    if mnemonic == '.include':
+                        # Include other assembly file.
+                        if len(operands) != 1:
+                            raise SyntaxError(f'{file}:{idx}: Expected string constant')
+                        if len(o) < 3 or (o[0] != '"' and o[0] != '\'') or (o[-1] != '"' and o[-1] != '\''):
+                            raise SyntaxError(f'{file}:{idx}: Malformed string constant {o}')
+                        if label != '':
+                            code.append((file, idx, label, ''))
+                        macros2 = {}
+                        lines = self._preprocess(os.path.join(dir, o[1:-1]), macros2)
+                        if emit:
+                            # Pass included lines through without collecting them.
+                            yield from self._emit(code, cached)
+                            code = []
+                            yield from self._emit(lines, cached)
+                        else:
+                            code.extend(lines)
+                        macros.update(macros2)
+                    elif mnemonic == '.dw':
+                        # Split .dw into single-word constants
+                        code.extend(self._splitdw(file, idx, label, inst))
+                    elif mnemonic == '.macro':
+                        # Create a new macro.
+                        if len(operands) != 1:
+                            raise SyntaxError(f'{file}:{idx}: Missing macro name')
+                        elif macro != '':
+                            raise SyntaxError(f'{file}:{idx}: Cannot nest macro definitions')
+                        elif o in defs:
+                            raise SyntaxError(f'{file}:{idx}: Macro definition {o} shadows mnemonic')
+                        elif o in macros:
+                            raise SyntaxError(f'{file}:{idx}: Redefinition of macro {o}')
+                        macro = o
+                        macros[macro] = []
+                    elif mnemonic == '.endmacro':
+                        # Macro finished.
+                        if macro == '':
+                            raise SyntaxError(f'{file}:{idx}: .endmacro without .macro')
+                        macros[macro] = self._compile(macros[macro])
+                        macro = ''
+                    elif mnemonic in macros:
+                        # Macro call. Emit macro contents into main instruction stream.
+                        if label != '':
+                            code.append((file, idx, label, ''))
+
+                        n = str(nonce)
+                        for (file2, idx2, label2, local, template, lo, hi, dw) in macros[mnemonic]:
+                            if lo < 0 or hi >= len(operands):
+                                raise SyntaxError(f'{file}:{idx}: Invalid argument ${lo if lo < 0 else hi} in call to macro {mnemonic}')
+                            if local:
+                                # Make label definition local
+                                label2 = label2 + n + '_'
+                            inst2 = template.format(*operands, n=n)
+                            if dw:
+                                code.extend(self._splitdw(file2, idx2, label2, inst2))
+                            else:
+                                code.append((file2, idx2, label2, inst2))
+                        nonce += 1
+                    else:
+                        code.append((file, idx, label, inst))
+                elif label != '':
                     code.append((file, idx, label, inst))
-            elif label != '':
-                code.append((file, idx, label, inst))
+            except Exception as e:
+                if self.errors is None:
+                    raise
+                self.errors.append(diagnostic(file, idx, e))
 
-        f.close()
+            if emit:
+                yield from self._emit(code, cached)
 
-        return asm, macros
+        if macro != '':
+            # Unterminated macro definition
+            macros[macro] = self._compile(macros[macro])
+
+    def _emit(self, lines, cached):
+        """Passes lines through, recording them if cached is a list.
+        Recording stops after exceeding self.cachelimit lines."""
+        for line in lines:
+            if cached is not None and len(cached) <= self.cachelimit:
+                cached.append(line)
+            yield line
 
     def _reindex(self, asm):
         """Combines file and line numbers into a single string."""
@@ -203,211 +406,633 @@ class Preprocessor:
             ret.append((f'{a[0]:>{midx}}:{a[1]:>{ml}}', a[2], a[3]))
         return ret
 
+# Inverse of each conditional branch.
+inverse = {'bz': 'bnz', 'beq': 'bnz', 'bnz': 'bz', 'bne': 'bz',
+           'bcs': 'bcc', 'bhs': 'bcc', 'bcc': 'bcs', 'blo': 'bcs',
+           'blt': 'bge', 'bge': 'blt'}
+
 class Assembler:
     """Assembler for normalized assembly."""
+    def __init__(self, shortjumps=False, relocatable=False):
+        """If shortjumps is set, jumps to labels within branch range are
+        replaced by unconditional branches. If relocatable is set, sections
+        start at 0, labels need not be defined, and the instructions that
+        refer to labels are listed in self.relocations for the Linker. The
+        labels named by .global directives are listed in self.exports."""
+        self.shortjumps = shortjumps
+        self.relocatable = relocatable
+        self.errors = None
+        self.lines = None
+
     def process(self, asm, origin):
-        """Emits machine code for normalized assembly."""
-        labels = self._pass1(asm, origin)
-        return self._pass2(asm, labels, origin)
+        """Emits machine code for normalized assembly.
 
-    def _pass1(self, lines, origin):
-        """Calculates label locations."""
-        section = 'code'
-        labels = {} # Absolute
-        loc = {'io': 0, 'code': 0, 'data': 0} # Relative to section base address
+        Branches to labels that are out of range are relaxed: unconditional
+        branches become jumps, and conditional branches become an inverted
+        branch over a jump, after which the program is reassembled until
+        the layout no longer changes.
 
-        for (idx, label, inst) in lines:
-            if label != '':
-                if label in labels:
-                    raise SyntaxError(f'{idx}: Redefinition of label {label}')
+        The assembly is iterated once per pass, so it may be a Stream.
 
-                labels[label] = origin[section] + loc[section]
+        Returns a dictionary of word arrays per section. The source line of
+        each word is available in self.meta, which has the same structure,
+        the absolute label values in self.labels, and the section of each
+        label in self.sections (None for .equ constants).
 
-            if inst == '':
-                continue
+        If self.errors is a list, errors are appended to it as diagnostics
+        and assembly continues with the next line. If self.lines is a
+        dictionary, it is filled with the (file, line) location of each
+        word per section."""
+        if self.relocatable:
+            origin = {s: 0 for s in origin}
+        self.long = set()
+        while True:
+            if self.errors is not None:
+                self.errors.clear()
+            mem = self._assemble(asm, origin)
+            if mem is not None:
+                return mem
 
-            mnemonic, operands = split(inst)
+    def _assemble(self, asm, origin):
+        """Emits machine code in a single pass. Instructions referring to
+        labels that are not yet defined are re-encoded once all labels
+        are known. Returns None if more branches need to be relaxed."""
+        mem = {'io': array.array('H'), 'code': array.array('H'), 'data': array.array('H')}
+        meta = {'io': [], 'code': [], 'data': []}
+        labels = {}
+        sections = {}
+        fixups = []
+        relocs = []
+        exports = []
+        relaxed = False
+        section = 'code'
+        midx, ml = 0, 0
 
-            if mnemonic == '.org':
-                if len(operands) < 1:
-                    raise SyntaxError(f'{idx}: {mnemonic} directive requires an address argument')
-                try:
-                    newloc = int(operands[0], 0)
-                except:
-                    raise ValueError(f'{idx}: Cannot parse {mnemonic} address {operands[0]}')
-                if newloc < loc[section]:
-                    raise ValueError(f'{idx}: {mnemonic} argument cannot reduce current address {loc}')
-                loc[section] = newloc
-
-                # Label before .org points to next instruction
+        for n, (idx, label, inst) in enumerate(asm):
+            # Track line number column widths
+            name, _, line = idx.rpartition(':')
+            midx = max(midx, len(name))
+            ml = max(ml, int(line))
+
+            start = len(mem[section])
+            try:
                 if label != '':
-                    labels[label] = origin[section] + newloc
-            elif mnemonic == '.equ':
-                # .equ just adds a new label and does not advance instruction
-                if len(operands) < 2:
-                    raise SyntaxError(f'{idx}: {mnemonic} directive requires 2 arguments')
-
-                labels[operands[0]] = int(operands[1], 0)
-            elif mnemonic == '.section':
-                section = operands[0]
-            else:
-                loc[section] += 1
+                    if label in labels:
+                        raise SyntaxError(f'{idx}: Redefinition of label {label}')
 
-        return labels
+                    labels[label] = origin[section] + len(mem[section])
+                    sections[label] = section
 
-    def _resolve(self, lidx, mnemonic, operands, labels, loc):
-        """Resolves instruction operands."""
-        if not mnemonic in defs:
-            raise SyntaxError(f"{lidx}: Unrecognized mnemonic '{mnemonic}'")
+                if inst == '':
+                    continue
 
-        for (opcode, minor, req) in defs[mnemonic]:
-            try:
-                if len(operands) != len(req):
-                    raise SyntaxError(f'{lidx}: {mnemonic} requires {len(req)} operand(s), found {operands}')
-
-                ret = []
-                for r, o in zip(req, operands):
-                    if r == 'R' or r == 'A':
-                        if r == 'A':
-                            # Register address
-                            if len(o) < 4 or o[0] != '[' or o[-1] != ']':
-                                raise SyntaxError(f"{lidx}: {mnemonic} operand '{o}' is not a valid indirect memory request")
-                            o = o[1:-1]
-
-                        # Register
-                        # TODO: register aliases (.def)
-                        if len(o) < 2 or o[0] != 'r' or int(o[1:]) < 0 or int(o[1:]) > 15:
-                            raise SyntaxError(f"{lidx}: {mnemonic} operand '{o}' is not a valid register")
-                        ret.append(f'{int(o[1:]):04b}')
-                    elif r == '4' or r == '8' or r == '2' or r == '6' or r == 'S' or r == 'B':
-                        # Constant or label evaluated as constant
-                        if len(o) == 3 and o[0] == r'"' and o[-1] == r'"':
-                            # Character
-                            if r == '8':
-                                ret.append(f'{ord(o[1]):08b}')
-                            elif r == '6':
-                                ret.append(f'{ord(o[1]):016b}')
-                            else:
-                                raise ValueError(f'{lidx}: Unexpected character constant {o}')
-                        else:
-                            # Getting specific bytes
-                            LSB, MSB = False, False
-                            if len(o) > 5 and (o[3] == '(' or o[4] == '(') and o[-1] == ')':
-                                if o[:3] == 'low':
-                                   o = o[4:-1]
-                                   LSB = True
-                                elif o[:4] == 'high':
-                                   o = o[5:-1]
-                                   MSB = True
-                                else:
-                                   raise SyntaxError(f"{lidx}: {mnemonic} operand '{o}' does not apply a value function")
-
-                            if len(o) > 1 and o[0] == '@':
-                                # Label
-                                if o[1:] in labels:
-                                    val = labels[o[1:]]
-                                else:
-                                    raise ValueError(f"{lidx}: label '{o}' not defined")
-                            else:
-                                # Constant
-                                try:
-                                    val = int(o, 0)
-                                except:
-                                    raise SyntaxError(f"{lidx}: {mnemonic} operand '{o}' is not a valid constant")
-
-                            if LSB:
-                                val = val&255
-                            elif MSB:
-                                val = (val>>8)&255
-
-                            if r == '4':
-                                if val < -8 or val > 15:
-                                    raise ValueError(f"{lidx}: {mnemonic} operand '{o}' ({val}) is not a valid 4-bit signed or unsigned constant")
-                                if val < 0:
-                                     val = 16+val
-                                ret.append(f'{val:04b}')
-                            elif r == '8':
-                                if val < -128 or val > 255:
-                                    raise ValueError(f"{lidx}: {mnemonic} operand '{o}' ({val}) is not a valid 8-bit signed or unsigned constant")
-                                if val < 0:
-                                    val = 256+val
-                                ret.append(f'{val:08b}')
-                            elif r == '2':
-                                if val < 0 or val > 4095:
-                                    raise ValueError(f"{lidx}: {mnemonic} operand '{o}' ({val}) is not a valid 12-bit unsigned constant")
-                                ret.append(f'{val:012b}')
-                            elif r == '6':
-                                if val < -32768 or val > 65535:
-                                    raise ValueError(f"{lidx}: {mnemonic} operand '{o}' ({val}) is not a valid 16-bit signed or unsigned constant")
-                                if val < 0:
-                                    val = 65536+val
-                                ret.append(f'{val:016b}')
-                            elif r == 'S':
-                                if val == 0 or abs(val) > 8:
-                                    raise ValueError(f"{lidx}: {mnemonic} operand '{o}' ({val}) is not a valid shift constant")
-                                if val < 0:
-                                    val = 8 + abs(val)-1
-                                else:
-                                    val = val-1
-                                ret.append(f'{val:04b}')
-                            elif r == 'B':
-                                val = val-loc-1
-                                if val < -128 or val > 127:
-                                    raise ValueError(f'{lidx}: conditional branch target {o} (pc+1+{val}) out of bounds')
-                                if val < 0:
-                                    val = 256+val
-                                ret.append(f'{val:08b}')
+                mnemonic, operands = split(inst)
+                loc = origin[section] + len(mem[section])
+
+                if mnemonic == '.org':
+                    if len(operands) < 1:
+                        raise SyntaxError(f'{idx}: {mnemonic} directive requires an address argument')
+                    try:
+                        newloc = int(operands[0], 0)
+                    except:
+                        raise ValueError(f'{idx}: Cannot parse {mnemonic} address {operands[0]}')
+                    if newloc < len(mem[section]):
+                        raise ValueError(f'{idx}: {mnemonic} argument cannot reduce current address {len(mem[section])}')
+                    self._resolve(idx, mnemonic, operands, labels, loc)
+
+                    # Fill memory until requested address
+                    fill = newloc - len(mem[section])
+                    mem[section].extend(array.array('H', [0]) * fill)
+                    meta[section].extend([None] * fill)
+
+                    # Label before .org points to next instruction
+                    if label != '':
+                        labels[label] = origin[section] + newloc
+                elif mnemonic == '.equ':
+                    # .equ just adds a new label and does not advance instruction
+                    if len(operands) < 2:
+                        raise SyntaxError(f'{idx}: {mnemonic} directive requires 2 arguments')
+                    self._resolve(idx, mnemonic, operands, labels, loc)
+
+                    labels[operands[0]] = int(operands[1], 0)
+                    sections[operands[0]] = None
+                elif mnemonic == '.section':
+                    _, operands = self._resolve(idx, mnemonic, operands, labels, loc)
+                    if operands[0] not in mem:
+                        raise SyntaxError(f'{idx}: Unknown section {operands[0]}, expected {", ".join(mem)}')
+                    section = operands[0]
+                elif mnemonic == '.global':
+                    # Only affects linking
+                    _, operands = self._resolve(idx, mnemonic, operands, labels, loc)
+                    exports.append((idx, operands[0]))
+                elif mnemonic != '.dw' and section != 'code':
+                    raise ValueError(f'{idx}: Cannot use instructions in data section')
+                elif mnemonic == 'ldi':
+                    long = n in self.long
+                    if self.relocatable and refs(operands):
+                        # Relocated value may not fit a short load
+                        long = long or sections.get(refs(operands)[0], '') is not None
+                        relocs.append((section, len(mem[section]), idx, mnemonic, operands, long))
+                    resolved = self._ldi(idx, operands, labels, loc, long)
+                    if resolved is None:
+                        # Forward reference
+                        fixups.append((section, len(mem[section]), idx, mnemonic, operands, loc, n))
+                        resolved = [0, 0] if long else [0]
+                    elif resolved == 'relax':
+                        self.long.add(n)
+                        relaxed = True
+                        resolved = [0]
+
+                    r, o = operands
+                    if len(resolved) == 1:
+                        mem[section].append(resolved[0])
+                        meta[section].append((idx, label, f'mov {r}, {o}'))
                     else:
-                        ret.append(o)
-                return opcode, minor, ret
+                        mem[section].extend(resolved)
+                        meta[section].append((idx, label, f'mov {r}, low({o})'))
+                        meta[section].append((idx, '', f'movt {r}, high({o})'))
+                elif n in self.long:
+                    # Branch over jump to out-of-range target
+                    if self.relocatable:
+                        relocs.append((section, len(mem[section]), idx, mnemonic, operands, True))
+                    code, _ = self._resolve(idx, inverse[mnemonic], [str(loc+2)], labels, loc)
+                    mem[section].append(code)
+                    meta[section].append((idx, label, f'{inverse[mnemonic]} {loc+2}'))
+
+                    resolved = self._resolve(idx, 'jmp', operands, labels, loc+1, False)
+                    if resolved is None:
+                        fixups.append((section, len(mem[section]), idx, 'jmp', operands, loc+1, n))
+                        mem[section].append(0)
+                    else:
+                        mem[section].append(resolved[0])
+                    meta[section].append((idx, '', f'jmp {operands[0]}'))
+                else:
+                    if self.relocatable and (refs(operands) or mnemonic in inverse or mnemonic == 'b'):
+                        relocs.append((section, len(mem[section]), idx, mnemonic, operands, False))
+                    listing = inst
+                    if mnemonic == 'jmp' or mnemonic in inverse or mnemonic == 'b':
+                        resolved = self._branch(idx, mnemonic, operands, labels, loc)
+                        listing = self._listing(inst, mnemonic, operands, labels, loc)
+                    else:
+                        resolved = self._resolve(idx, mnemonic, operands, labels, loc, False)
+
+                    if resolved is None:
+                        # Forward reference
+                        fixups.append((section, len(mem[section]), idx, mnemonic, operands, loc, n))
+                        mem[section].append(0)
+                    elif resolved == 'relax':
+                        self.long.add(n)
+                        relaxed = True
+                        mem[section].append(0)
+                    else:
+                        mem[section].append(resolved[0])
+                    meta[section].append((idx, label, listing))
             except Exception as e:
-                lastex = e
-        raise lastex
+                if self.errors is None:
+                    raise
+                self.errors.append(diagnostic(*location(idx), e))
+                if len(mem[section]) == start and inst != '' and (inst[0] != '.' or inst.startswith('.dw')):
+                    # Keep the addresses of subsequent lines
+                    mem[section].append(0)
+                    meta[section].append((idx, label, inst))
 
-    def _pass2(self, lines, labels, origin):
-        """Emits machine code."""
-        mem = {'io': [], 'code': [], 'data': []}
-        section = 'code'
+        for (section, addr, idx, mnemonic, operands, loc, n) in fixups:
+            if self.relocatable and any([r not in labels for r in refs(operands)]):
+                # External label, resolved by the linker
+                if mnemonic in inverse and not n in self.long:
+                    self.long.add(n)
+                    relaxed = True
+                continue
+            try:
+                if mnemonic == 'ldi':
+                    resolved = self._ldi(idx, operands, labels, loc, n in self.long, True)
+                elif mnemonic == 'jmp' or mnemonic in inverse or mnemonic == 'b':
+                    resolved = self._branch(idx, mnemonic, operands, labels, loc, True)
+                else:
+                    resolved = self._resolve(idx, mnemonic, operands, labels, loc)
+            except Exception as e:
+                if self.errors is None:
+                    raise
+                self.errors.append(diagnostic(*location(idx), e))
+                continue
+
+            if resolved == 'relax':
+                self.long.add(n)
+                relaxed = True
+            elif mnemonic == 'ldi':
+                mem[section][addr:addr+len(resolved)] = array.array('H', resolved)
+            else:
+                mem[section][addr] = resolved[0]
+                i, l, listing = meta[section][addr]
+                meta[section][addr] = (i, l, self._listing(listing, mnemonic, operands, labels, loc))
+
+        if relaxed:
+            return None
+
+        for idx, name in exports:
+            if sections.get(name) is None:
+                e = SyntaxError(f'{idx}: Exported label {name} not defined in a section')
+                if self.errors is None:
+                    raise e
+                self.errors.append(diagnostic(*location(idx), e))
+
+        self.labels = labels
+        self.sections = sections
+        self.exports = list(dict.fromkeys([name for _, name in exports]))
+        self.relocations = [r for r in relocs if self._relocated(r, sections)]
+        if self.lines is not None:
+            self.lines.clear()
+            self.lines.update({s: [None if m is None else location(m[0]) for m in meta[s]] for s in meta})
+        if ml > 0:
+            ml = math.ceil(math.log10(ml))
+        self.meta = self._format(meta, labels, midx, ml)
+        return mem
+
+    def _relocated(self, reloc, sections):
+        """Returns whether an instruction must be re-encoded when its
+        section is moved."""
+        section, _, _, mnemonic, operands, long = reloc
+        names = refs(operands)
+        if mnemonic in inverse and not long:
+            # Conditional branches are relative to the instruction
+            return not names or any([sections.get(l) != section for l in names])
+        return mnemonic == 'b' or any([sections.get(l, '') is not None for l in names])
+
+    def _form(self, mnemonic, operands, labels, loc):
+        """Returns the mnemonic of the form of a branch or jump that reaches
+        its label target, or 'relax' if a conditional branch cannot reach
+        it. Targets that are not known labels keep the mnemonic."""
+        if len(operands) != 1 or operands[0][0] != '@' or not operands[0][1:] in labels:
+            return mnemonic
+
+        offset = labels[operands[0][1:]] - loc - 1
+        if offset >= -128 and offset <= 127:
+            if mnemonic == 'jmp' and self.shortjumps:
+                return 'b'
+        elif mnemonic == 'b':
+            return 'jmp'
+        elif mnemonic != 'jmp':
+            return 'relax'
+        return mnemonic
+
+    def _branch(self, idx, mnemonic, operands, labels, loc, final=False):
+        """Resolves a branch or jump, using a form that reaches a label
+        target. Returns 'relax' if a conditional branch cannot reach
+        its target, and None if the target is not yet known and not final."""
+        form = self._form(mnemonic, operands, labels, loc)
+        if form == 'relax':
+            return 'relax'
+        return self._resolve(idx, form, operands, labels, loc, final)
+
+    def _listing(self, inst, mnemonic, operands, labels, loc):
+        """Annotates the listing of a branch or jump that is assembled in
+        another form, such that it matches the encoded word."""
+        form = self._form(mnemonic, operands, labels, loc)
+        if form == mnemonic or form == 'relax':
+            return inst
+        note = f' ; {"relaxed" if form == "jmp" else "shortened"} to {form}'
+        return inst if inst.endswith(note) else inst + note
+
+    def _ldi(self, idx, operands, labels, loc, long, final=False):
+        """Resolves a constant load to mov, or if long to mov and movt.
+        Returns the words, 'relax' if the value does not fit a short load,
+        or None if the value is not yet known and not final."""
+        if len(operands) != 2:
+            raise SyntaxError(f'{idx}: ldi requires 2 operand(s), found {operands}')
+        resolved = self._resolve(idx, 'ldi', operands, labels, loc, final)
+        if resolved is None:
+            return None
 
+        val = resolved[1][1]
+        if val > 255 and not long:
+            return 'relax'
+
+        code = [self._resolve(idx, 'mov', [operands[0], str(val & 255)], labels, loc)[0]]
+        if long:
+            code.append(self._resolve(idx, 'movt', [operands[0], str(val >> 8)], labels, loc+1)[0])
+        return code
+
+    def _format(self, meta, labels, midx, ml):
+        """Formats source lines as comments, aligning file names to midx
+        characters, line numbers to ml characters, and labels."""
         ls = 0
         for l in labels:
             ls = max(ls, len(l))
 
-        ref = ' ' * (ls + 2)
-        for (idx, label, inst) in lines:
-            if label != '':
-                ref = f'{label}: ' + ' ' * (ls-len(label))
-            else:
-                ref = ' ' * (ls + 2)
+        for section in meta:
+            lines = meta[section]
+            for i, m in enumerate(lines):
+                if m is None:
+                    lines[i] = ''
+                else:
+                    (idx, label, inst) = m
+                    name, _, line = idx.rpartition(':')
+                    idx = f'{name:>{midx}}:{line.strip():>{ml}}'
+                    if label != '':
+                        ref = f'{label}: ' + ' ' * (ls-len(label))
+                    else:
+                        ref = ' ' * (ls + 2)
+                    lines[i] = f'{idx}: {ref}{inst}'
+        return meta
 
-            if inst == '':
-                continue
+    def _resolve(self, lidx, mnemonic, operands, labels, loc, final=True):
+        """Resolves instruction operands, returning the encoded word and the
+        operand values. If not final, returns None when the instruction
+        refers to an undefined label."""
+        encoding = signatures.get((mnemonic, ''.join([kind(o) for o in operands])))
+        if encoding is not None:
+            return self._encode(lidx, mnemonic, encoding, operands, labels, loc, final)
 
-            mnemonic, operands = split(inst)
-            opcode, minor, operands = self._resolve(idx, mnemonic, operands, labels, origin[section] + len(mem[section]))
-
-            if mnemonic == '.section':
-                section = operands[0]
-            elif mnemonic == '.equ':
-                # Ignore
-                pass
-            elif mnemonic == '.org':
-                # Fill memory until requested address
-                while len(mem[section]) < int('0b' + operands[0], 0):
-                    mem[section].append(('0000000000000000', ''))
-            elif mnemonic == '.dw':
-                # Add word into instruction stream
-                mem[section].append((operands[0], f'{idx}: {ref}{inst}'))
-            elif section != 'code':
-                raise ValueError(f'{idx}: Cannot use instructions in data section')
+        if not mnemonic in defs:
+            raise SyntaxError(f"{lidx}: Unrecognized mnemonic '{mnemonic}'")
+        if not final:
+            # Diagnose once all labels are known.
+            return None
+
+        # Report why the last encoding with the right number of operands does not apply.
+        for encoding in reversed(defs[mnemonic]):
+            if len(encoding[2]) == len(operands):
+                self._encode(lidx, mnemonic, encoding, operands, labels, loc)
+                break
+        raise SyntaxError(f'{lidx}: {mnemonic} requires {len(defs[mnemonic][-1][2])} operand(s), found {operands}')
+
+    def _encode(self, lidx, mnemonic, encoding, operands, labels, loc, final=True):
+        """Encodes instruction operands for a specific encoding."""
+        (opcode, minor, req) = encoding
+
+        if len(operands) != len(req):
+            raise SyntaxError(f'{lidx}: {mnemonic} requires {len(req)} operand(s), found {operands}')
+
+        ret = []
+        for r, o in zip(req, operands):
+            if r == 'R' or r == 'A':
+                if r == 'A':
+                    # Register address
+                    if len(o) < 4 or o[0] != '[' or o[-1] != ']':
+                        raise SyntaxError(f"{lidx}: {mnemonic} operand '{o}' is not a valid indirect memory request")
+                    o = o[1:-1]
+
+                # Register
+                # TODO: register aliases (.def)
+                if len(o) < 2 or o[0] != 'r' or int(o[1:]) < 0 or int(o[1:]) > 15:
+                    raise SyntaxError(f"{lidx}: {mnemonic} operand '{o}' is not a valid register")
+                ret.append(int(o[1:]))
+            elif r == '4' or r == '8' or r == '2' or r == '6' or r == 'S' or r == 'B':
+                # Constant or label evaluated as constant
+                if len(o) == 3 and o[0] == r'"' and o[-1] == r'"':
+                    # Character
+                    if r == '8' or r == '6':
+                        ret.append(ord(o[1]))
+                    else:
+                        raise ValueError(f'{lidx}: Unexpected character constant {o}')
+                else:
+                    # Getting specific bytes
+                    LSB, MSB = False, False
+                    if len(o) > 5 and (o[3] == '(' or o[4] == '(') and o[-1] == ')':
+                        if o[:3] == 'low':
+                           o = o[4:-1]
+                           LSB = True
+                        elif o[:4] == 'high':
+                           o = o[5:-1]
+                           MSB = True
+                        else:
+                           raise SyntaxError(f"{lidx}: {mnemonic} operand '{o}' does not apply a value function")
+
+                    if len(o) > 1 and o[0] == '@':
+                        # Label
+                        if o[1:] in labels:
+                            val = labels[o[1:]]
+                        elif not final:
+                            return None
+                        else:
+                            raise ValueError(f"{lidx}: label '{o}' not defined")
+                    else:
+                        # Constant
+                        try:
+                            val = int(o, 0)
+                        except:
+                            raise SyntaxError(f"{lidx}: {mnemonic} operand '{o}' is not a valid constant")
+
+                    if LSB:
+                        val = val&255
+                    elif MSB:
+                        val = (val>>8)&255
+
+                    if r == '4':
+                        if val < -8 or val > 15:
+                            raise ValueError(f"{lidx}: {mnemonic} operand '{o}' ({val}) is not a valid 4-bit signed or unsigned constant")
+                        if val < 0:
+                             val = 16+val
+                        ret.append(val)
+                    elif r == '8':
+                        if val < -128 or val > 255:
+                            raise ValueError(f"{lidx}: {mnemonic} operand '{o}' ({val}) is not a valid 8-bit signed or unsigned constant")
+                        if val < 0:
+                            val = 256+val
+                        ret.append(val)
+                    elif r == '2':
+                        if val < 0 or val > 4095:
+                            raise ValueError(f"{lidx}: {mnemonic} operand '{o}' ({val}) is not a valid 12-bit unsigned constant")
+                        ret.append(val)
+                    elif r == '6':
+                        if val < -32768 or val > 65535:
+                            raise ValueError(f"{lidx}: {mnemonic} operand '{o}' ({val}) is not a valid 16-bit signed or unsigned constant")
+                        if val < 0:
+                            val = 65536+val
+                        ret.append(val)
+                    elif r == 'S':
+                        if val == 0 or abs(val) > 8:
+                            raise ValueError(f"{lidx}: {mnemonic} operand '{o}' ({val}) is not a valid shift constant")
+                        if val < 0:
+                            val = 8 + abs(val)-1
+                        else:
+                            val = val-1
+                        ret.append(val)
+                    elif r == 'B':
+                        val = val-loc-1
+                        if val < -128 or val > 127:
+                            raise ValueError(f'{lidx}: conditional branch target {o} (pc+1+{val}) out of bounds')
+                        if val < 0:
+                            val = 256+val
+                        ret.append(val)
             else:
-                instcode = opcode
-                for o in operands:
-                    instcode += o
-                instcode += minor
+                ret.append(o)
+
+        code = int(opcode, 2) if opcode != '' else 0
+        for r, o in zip(req, ret):
+            if r in widths:
+                code = (code << widths[r]) | o
+        if minor != '':
+            code = (code << len(minor)) | int(minor, 2)
+        return code, ret
+
+# Default section origins.
+ORIGIN = {'io': 0, 'code': 16, 'data': 4096}
+
+class Result:
+    """Assembled program.
+
+    mem has a word array per section, placed at origin. labels and sections
+    give the address and section of each label, lines the (file, line)
+    location of each word, and meta its listing comment. diagnostics is a
+    list of (file, line, message) tuples for all errors."""
+    def __init__(self, mem, origin, labels, sections, lines, meta, diagnostics):
+        self.mem = mem
+        self.origin = origin
+        self.labels = labels
+        self.sections = sections
+        self.lines = lines
+        self.meta = meta
+        self.diagnostics = diagnostics
+
+    @property
+    def ok(self):
+        """Whether the program assembled without errors."""
+        return not self.diagnostics
+
+def assemble(source=None, file=None, origin=ORIGIN, shortjumps=False, cachedir=None):
+    """Assembles source text, or the file at path file, into a Result. file
+    may also be a list of paths, which are assembled together. Errors do
+    not stop assembly; all of them are reported in the diagnostics of the
+    result, in line order."""
+    pp = Preprocessor(cachedir)
+    pp.errors = []
+    if file is None:
+        file = io.StringIO(source)
+    files = file if isinstance(file, list) else [file]
+    asm = [line for f in files for line in pp.stream(f)]
+
+    ass = Assembler(shortjumps)
+    ass.errors = []
+    ass.lines = {}
+    mem = ass.process(asm, origin)
+
+    # Label errors are found after the first pass
+    diagnostics = pp.errors + ass.errors
+    order = {d[0]: n for n, d in reversed(list(enumerate(diagnostics)))}
+    diagnostics.sort(key=lambda d: (order[d[0]], d[1]))
 
-                mem[section].append((instcode, f'{idx}: {ref}{inst}'))
+    return Result(mem, origin, ass.labels, ass.sections, ass.lines, ass.meta, diagnostics)
 
-            ref = ' ' * (ls + 2)
+# Object file format version.
+OBJECT_VERSION = 2
+
+class Object:
+    """Relocatable object.
+
+    mem and meta have the words and listing comments of each section,
+    labels the label values, relative to the start of their section in
+    sections (None for .equ constants), and relocations the instructions
+    that refer to labels, as (section, offset, idx, mnemonic, operands,
+    long) tuples. long marks two-word forms: ldi as mov and movt, and a
+    conditional branch as an inverse branch over a jmp. Only the labels in
+    exports are visible to other objects."""
+    def __init__(self, mem, meta, labels, sections, relocations, file='<object>', exports=None):
+        self.mem = mem
+        self.meta = meta
+        self.labels = labels
+        self.sections = sections
+        self.relocations = relocations
+        self.file = file
+        self.exports = [] if exports is None else exports
+
+    def exported(self, name):
+        """Returns whether a label is visible to other objects."""
+        return name in self.exports
+
+    def save(self, f):
+        """Writes object as JSON."""
+        json.dump({'puc16': OBJECT_VERSION,
+                   'mem': {s: list(self.mem[s]) for s in self.mem},
+                   'meta': self.meta,
+                   'labels': self.labels,
+                   'sections': self.sections,
+                   'relocations': self.relocations,
+                   'exports': self.exports}, f)
+
+    @staticmethod
+    def load(file):
+        """Reads object from file."""
+        with open(file, 'r') as f:
+            try:
+                obj = json.load(f)
+            except ValueError:
+                obj = None
+        if not isinstance(obj, dict) or obj.get('puc16') != OBJECT_VERSION:
+            raise ValueError(f'{file}: Not a PUC16 object file')
+        return Object({s: array.array('H', obj['mem'][s]) for s in obj['mem']},
+                      obj['meta'], obj['labels'], obj['sections'],
+                      [tuple(r) for r in obj['relocations']], file, obj['exports'])
+
+class Linker:
+    """Linker for relocatable objects."""
+    def __init__(self, shortjumps=False):
+        """If shortjumps is set, jumps to labels within branch range are
+        replaced by unconditional branches."""
+        self.assembler = Assembler(shortjumps)
+
+    def process(self, objects, origin):
+        """Places the sections of the objects one after the other from
+        origin, and re-encodes the relocations. Returns a dictionary of word
+        arrays per section, like Assembler.process. The exported labels are
+        available in self.labels and self.sections."""
+        mem = {s: array.array('H') for s in origin}
+        meta = {s: [] for s in origin}
+        labels = {}
+        sections = {}
+        bases = []
+
+        for obj in objects:
+            base = {s: origin[s] + len(mem[s]) for s in origin}
+            bases.append(base)
+            for s in obj.mem:
+                mem[s].extend(obj.mem[s])
+                meta[s].extend(obj.meta[s])
+
+            for name, value in obj.labels.items():
+                s = obj.sections[name]
+                if s is not None and obj.exported(name):
+                    if name in labels:
+                        raise SyntaxError(f'{obj.file}: Redefinition of label {name}')
+                    labels[name] = base[s] + value
+                    sections[name] = s
+
+        ass = self.assembler
+        for obj, base in zip(objects, bases):
+            # Labels of the object itself take precedence
+            local = dict(labels)
+            for name, value in obj.labels.items():
+                s = obj.sections[name]
+                local[name] = value if s is None else base[s] + value
+
+            for (s, offset, idx, mnemonic, operands, long) in obj.relocations:
+                loc = base[s] + offset
+                if mnemonic in inverse and long:
+                    # The inverse branch is relative, but its listing is not
+                    listing = meta[s][loc - origin[s]]
+                    old = f'{inverse[mnemonic]} {offset+2}'
+                    meta[s][loc - origin[s]] = listing[:-len(old)] + f'{inverse[mnemonic]} {loc+2}'
+                    mnemonic, offset, loc = 'jmp', offset+1, loc+1
+
+                if mnemonic == 'ldi':
+                    resolved = ass._ldi(idx, operands, local, loc, long, True)
+                elif mnemonic == 'jmp' or mnemonic in inverse or mnemonic == 'b':
+                    resolved = ass._branch(idx, mnemonic, operands, local, loc, True)
+                else:
+                    resolved = ass._resolve(idx, mnemonic, operands, local, loc)
+
+                if resolved == 'relax':
+                    raise ValueError(f'{idx}: {mnemonic} operand {operands[-1]} out of bounds')
+
+                addr = loc - origin[s]
+                if mnemonic == 'ldi':
+                    mem[s][addr:addr+len(resolved)] = array.array('H', resolved)
+                else:
+                    mem[s][addr] = resolved[0]
+                    if mnemonic == 'jmp' or mnemonic == 'b':
+                        meta[s][addr] = ass._listing(meta[s][addr], mnemonic, operands, local, loc)
 
+        self.labels = labels
+        self.sections = sections
+        self.meta = meta
         return mem
@@ -4,65 +4,125 @@
    (c) 2020-2025 Wouter Caarls, PUC-Rio
 """
 
-import sys, io, argparse
+import os, sys, argparse
+from concurrent.futures import ProcessPoolExecutor
 
-from .compiler import compile
-from .assembler import Preprocessor, Assembler
-from .simulator import Simulator
-from .emitter import emitasm, emitvhdl
+from .compiler import compile, compileobject, startupobject
+from .assembler import Assembler, Linker
+from .simulator import simulate
+from .image import imageformat, load as loadimage
+from .emitter import emitasm, emitters, emitmap, emitdeps
 
 def main():
     parser = argparse.ArgumentParser(description='PUC16 C compiler (c) 2020-2025 Wouter Caarls, PUC-Rio')
     parser.add_argument('file', type=str,
-                        help='C source file')
+                        help='C source file or memory image (.bin, .hex, .vhd, .coe, .mif, .mem)')
+    parser.add_argument('sources', metavar='FILE', type=str, nargs='*',
+                        help='Further C source files to compile and link')
     parser.add_argument('-o', '--output', type=str,
                         help='Output file', default='-')
+    parser.add_argument('-f', '--format', metavar='FMT', type=str, choices=list(emitters),
+                        help='Memory image format: ' + ', '.join(emitters) + ' (default: from output file extension, or vhdl)')
     parser.add_argument('-s', '--simulate', action='store_true',
                         help='Simulate resulting program')
     parser.add_argument('-v', '--vga', action='store_true',
                         help='Visualize VGA output during simulation')
     parser.add_argument('-t', '--test', metavar='N', type=int,
                         help='Simulate for 1000 steps and check whether PC == N')
+    parser.add_argument('-p', '--profile', action='store_true',
+                        help='Report memory usage after simulation')
+    parser.add_argument('--record', metavar='FILE', type=str,
+                        help='Record I/O reads during simulation')
+    parser.add_argument('--replay', metavar='FILE', type=str,
+                        help='Replay I/O reads recorded with --record')
+    parser.add_argument('--save-state', metavar='FILE', type=str,
+                        help='Save simulator state after simulation')
+    parser.add_argument('--load-state', metavar='FILE', type=str,
+                        help='Resume simulation from saved state')
+    parser.add_argument('--map', metavar='FILE', type=str,
+                        help='Write label addresses and section usage to FILE')
+    parser.add_argument('-MD', action='store_true',
+                        help='Write a Makefile dependency file for the output')
+    parser.add_argument('-MF', metavar='FILE', type=str,
+                        help='Dependency file (default: output with .d extension)')
+    parser.add_argument('--short-jumps', action='store_true',
+                        help='Replace jumps by branches where in range')
+    parser.add_argument('--cache', metavar='DIR', type=str,
+                        help='Cache compiled files in DIR')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        help='Number of files compiled in parallel (default: number of processors)')
     parser.add_argument('-S', action='store_true',
                         help='Output assembly code')
-    parser.add_argument('-O', type=int,
-                        help='Optimization level', default='2', choices=[0, 1, 2])
+    parser.add_argument('-O', type=str,
+                        help='Optimization level: 0 (none), 1 (cheap passes), 2 (all passes) or s (size)', default='2', choices=['0', '1', '2', 's'])
 
     args = parser.parse_args()
+    if args.MF is not None:
+        args.MD = True
+    if args.MD and args.output == '-':
+        parser.error('-MD requires -o')
+    if args.format is None:
+        args.format = imageformat(args.output) or 'vhdl'
+    if args.sources and args.S:
+        parser.error('-S requires a single C source file')
 
-    with open(args.file, 'r') as f:
-        asm = io.StringIO(compile(f, args.O))
+    if imageformat(args.file) is not None:
+        # Simulate prebuilt memory image
+        if not args.simulate and args.test is None:
+            parser.error('memory images can only be simulated')
+        simulate(args, loadimage(args.file), None)
+        return
 
-    pp  = Preprocessor()
-    asm = pp.process(asm)
-
-    ass = Assembler()
     origin = {'io': 0, 'code': 16, 'data': 4096}
-    mem = ass.process(asm, origin)
+    if args.sources:
+        # Compile translation units separately and link them after the startup code.
+        files = [args.file] + args.sources
+        with ProcessPoolExecutor(args.jobs) as pool:
+            units = list(pool.map(compileobject, files, [args.O] * len(files),
+                                  [args.cache] * len(files), [args.short_jumps] * len(files)))
+
+        objects = [startupobject(args.short_jumps)]
+        dependencies = []
+        for obj, deps in units:
+            objects.append(obj)
+            dependencies.extend(deps)
+
+        ass = Linker(args.short_jumps)
+        mem = ass.process(objects, origin)
+    else:
+        with open(args.file, 'r') as f:
+            dependencies = [args.file]
+            asm = compile(f, args.O, dependencies, args.cache)
+
+        ass = Assembler(args.short_jumps)
+        mem = ass.process(asm, origin)
+
+    if args.map:
+        with open(args.map, 'w') as m:
+            emitmap(mem, m, origin, ass.labels, ass.sections, ass.meta)
 
     if args.simulate or args.test:
-        sim = Simulator()
-        if args.simulate:
-            sim.process(mem, origin, args.vga)
-        else:
-            pc = sim.run(mem, origin, 1000)
-            if pc != args.test:
-                raise RuntimeError('PC after 1000 steps is ' + str(pc) + ', expected ' + str(args.test))
+        simulate(args, mem, origin)
     else:
+        binary = args.format == 'raw' and not args.S
         if args.output != '-':
-            f = open(args.output, 'w')
+            f = open(args.output, 'wb' if binary else 'w')
         else:
-            f = sys.stdout
+            f = sys.stdout.buffer if binary else sys.stdout
 
         if args.S:
             # Don't emit machine code, just compiled assembly.
             for (idx, label, inst) in asm:
                 print((label + ': ' if label != '' else '') + inst, file=f)
         else:
-            emitvhdl(mem, f, origin)
+            emitters[args.format](mem, f, origin, ass.meta)
 
         if args.output != '-':
             f.close()
 
+    if args.MD:
+        with open(args.MF or os.path.splitext(args.output)[0] + '.d', 'w') as d:
+            emitdeps(args.output, dependencies, d)
+
 if __name__ == '__main__':
     main()
@@ -2,13 +2,21 @@
    (c) 2020-2024 Wouter Caarls, PUC-Rio
 """
 
+import os, glob, hashlib, marshal
 from io import StringIO
 
-from .ppci.lang.c import c_to_ir
-from .ppci.api import ir_to_assembly, optimize
+from .assembler import Preprocessor, Assembler, Object, ORIGIN, normalize
+from .ppci.lang.c import c_to_ir, COptions
+from .ppci.lang.c.preprocessor import CPreProcessor
+from .ppci.lang.c.utils import LineInfo
+from .ppci.api import ir_to_stream, optimize
+from .ppci.opt import DeadSymbolEliminationPass
+from .ppci.binutils.outstream import OutputStream
+from .ppci.arch.generic_instructions import Label, Global, SetSymbolType, Alignment, SectionInstruction
+from .ppci.arch.data_instructions import DByte, DZero
 
-def compile(src, opt_level):
-    asm = """
+# Memory-mapped I/O registers and startup code.
+PRELUDE = """
 .section io
 btn: .dw 0
 enc: .dw 0
@@ -20,6 +28,16 @@ ssd: .dw 0
 ldr: .dw 0
 lcr: .dw 0
 
+.global btn
+.global enc
+.global kdr
+.global udr
+.global usr
+.global led
+.global ssd
+.global ldr
+.global lcr
+
 .section code
 
 add r12, r15, 2
@@ -27,28 +45,181 @@ push r12
 jmp @main
 loop: b @loop
 """
-    ir_module = c_to_ir(src, 'puc16')
-    optimize(ir_module, level=opt_level)
 
-    ppci_asm = StringIO(ir_to_assembly([ir_module], 'puc16'))
-
-    lbl = ''
-    for l in ppci_asm.readlines():
-        l = l.lstrip().rstrip()
-        if l.startswith('global') or l.startswith('type') or l.startswith('ALIGN'):
-            pass
-        elif l.endswith(':'):
-            if lbl != '':
-                lbl += '\n'
-            lbl += l + ' '
-        elif l.startswith('.byte'):
-            asm += lbl + ' .dw' + l[5:] + '\n'
-            lbl = ''
-        elif l.startswith('section'):
-            asm += lbl + ' .' + l + '\n'
-            lbl = ''
+class AssemblyStream(OutputStream):
+    """Output stream that collects code generator instructions as
+    normalized assembly, numbering them from line. The labels of global
+    symbols are collected in globals."""
+    def __init__(self, file='<stdin>', line=1):
+        self.file = file
+        self.line = line
+        self.label = ''
+        self.asm = []
+        self.globals = []
+
+    def do_emit(self, item):
+        if isinstance(item, Global):
+            self.globals.append(normalize(item.name))
+        elif isinstance(item, (SetSymbolType, Alignment)):
+            return
+        elif isinstance(item, Label):
+            if self.label != '':
+                self._append('')
+            self.label = normalize(item.name)
+        elif isinstance(item, SectionInstruction):
+            self._append('.section ' + item.name)
+        elif isinstance(item, DByte):
+            self._append(f'.dw {item.v}')
+        elif isinstance(item, DZero):
+            # Uninitialized variable
+            for i in range(item.v):
+                self.asm.append((f'{self.file}:{self.line}', self.label, '.dw 0'))
+                self.label = ''
+            self.line += 1
         else:
-            asm += lbl + l + '\n'
-            lbl = ''
+            self._append(normalize(str(item)))
+
+    def _append(self, inst):
+        if self.label != '' or inst != '':
+            self.asm.append((f'{self.file}:{self.line}', self.label, inst))
+        self.label = ''
+        self.line += 1
+
+class Cache:
+    """On-disk cache of compiled files. When the files in dir exceed limit
+    bytes, the least recently used ones are removed."""
+    def __init__(self, dir, limit=64*1024*1024):
+        self.dir = dir
+        self.limit = limit
+
+    def lookup(self, key):
+        """Returns the cached entry for a key, or None."""
+        path = os.path.join(self.dir, key + '.cache')
+        try:
+            with open(path, 'rb') as f:
+                entry = marshal.load(f)
+            os.utime(path)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return entry
+
+    def store(self, key, entry):
+        """Caches an entry, evicting old entries if needed."""
+        os.makedirs(self.dir, exist_ok=True)
+        path = os.path.join(self.dir, key + '.cache')
+        tmp = path + f'.{os.getpid()}'
+        with open(tmp, 'wb') as f:
+            marshal.dump(entry, f)
+        os.replace(tmp, path)
+
+        files = []
+        for file in glob.glob(os.path.join(self.dir, '*.cache')):
+            try:
+                st = os.stat(file)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, file))
+
+        size = sum([f[1] for f in files])
+        for _, fsize, file in sorted(files):
+            if size <= self.limit:
+                break
+            if file != path:
+                try:
+                    os.remove(file)
+                except OSError:
+                    pass
+                size -= fsize
+
+_version = None
+
+def version():
+    """Returns a digest of the compiler sources, such that cached results
+    are invalidated when the compiler changes."""
+    global _version
+    if _version is None:
+        h = hashlib.sha256()
+        for file in sorted(glob.glob(os.path.join(os.path.dirname(__file__), '**', '*.py'), recursive=True)):
+            st = os.stat(file)
+            h.update(f'{file}\0{st.st_size}\0{st.st_mtime_ns}\0'.encode())
+        _version = h.hexdigest()
+    return _version
 
+def _key(src, opt_level, name, dependencies):
+    """Hashes the preprocessed tokens of C source, the optimization level,
+    the listing file name and the compiler version."""
+    h = hashlib.sha256(f'{version()}\0{opt_level}\0{name}\0'.encode())
+    preprocessor = CPreProcessor(COptions())
+    for token in preprocessor.process_file(src, getattr(src, 'name', None)):
+        if not isinstance(token, LineInfo):
+            h.update(f'{token.typ}\0{token.val}\0'.encode())
+    if dependencies is not None:
+        dependencies.extend(preprocessor.dependencies)
+    return h.hexdigest()
+
+def startup():
+    """Returns the startup code as normalized assembly."""
+    return list(Preprocessor().stream(StringIO(PRELUDE)))
+
+def compile(src, opt_level, dependencies=None, cachedir=None, prelude=True, exports=None):
+    """Compiles C source to normalized assembly, as (idx, label, inst)
+    tuples that can be passed to Assembler.process. If dependencies is a
+    list, the paths of all included files are appended to it. If cachedir
+    is given, the assembly is cached there by preprocessed source.
+
+    If prelude is False, the startup code is left out and the statements
+    are numbered from the start of the source file. If exports is a list,
+    the labels of global symbols are appended to it."""
+    name = '<stdin>' if prelude else getattr(src, 'name', '<stdin>')
+    if cachedir is not None:
+        cache = Cache(cachedir)
+        key = _key(src, opt_level, name, dependencies)
+        entry = cache.lookup(key)
+        if entry is not None:
+            if exports is not None:
+                exports.extend(entry[1])
+            return entry[0]
+        src.seek(0)
+        dependencies = None
+
+    ir_module = c_to_ir(src, 'puc16', dependencies=dependencies)
+    optimize(ir_module, level=opt_level)
+    if str(opt_level) != '0':
+        # Remove what main, or any global symbol of a separate file, does not use
+        DeadSymbolEliminationPass(['main'] if prelude else None).run(ir_module)
+
+    if prelude:
+        stream = AssemblyStream(name, PRELUDE.count('\n') + 1)
+    else:
+        stream = AssemblyStream(name)
+    ir_to_stream(ir_module, 'puc16', stream, opt='size' if str(opt_level) == 's' else 'speed')
+
+    asm = startup() + stream.asm if prelude else stream.asm
+    if cachedir is not None:
+        cache.store(key, (asm, stream.globals))
+    if exports is not None:
+        exports.extend(stream.globals)
     return asm
+
+def _object(asm, file, shortjumps, exports=None):
+    """Assembles normalized assembly into a relocatable Object. If exports
+    is None, the labels named by .global directives are exported."""
+    ass = Assembler(shortjumps, True)
+    mem = ass.process(asm, ORIGIN)
+    if exports is None:
+        exports = ass.exports
+    return Object(mem, ass.meta, ass.labels, ass.sections, ass.relocations, file, exports)
+
+def startupobject(shortjumps=False):
+    """Returns the startup code as a relocatable Object, to be linked
+    before the compiled files."""
+    return _object(startup(), '<startup>', shortjumps)
+
+def compileobject(file, opt_level, cachedir=None, shortjumps=False):
+    """Compiles a C source file into a relocatable Object that exports its
+    global symbols. Returns the object and the paths of all files read."""
+    dependencies = [file]
+    exports = []
+    with open(file, 'r') as f:
+        asm = compile(f, opt_level, dependencies, cachedir, False, exports)
+    return _object(asm, file, shortjumps, exports), dependencies
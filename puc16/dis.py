@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+"""Disassembler for ENG1448 16-bit processor
+   (c) 2020-2025 Wouter Caarls, PUC-Rio
+"""
+
+import os, sys, argparse
+
+from .disassembler import disassemble, loadsymbols
+from .image import imageformat, formats, load as loadimage
+
+def main():
+    parser = argparse.ArgumentParser(description='PUC16 Disassembler (c) 2020-2025 Wouter Caarls, PUC-Rio')
+    parser.add_argument('file', type=str,
+                        help='Memory image (.bin, .hex, .vhd, .coe, .mif, .mem)')
+    parser.add_argument('-o', '--output', type=str,
+                        help='Output file', default='-')
+    parser.add_argument('-f', '--format', metavar='FMT', type=str, choices=sorted(set(formats.values())),
+                        help='Memory image format (default: from file extension)')
+    parser.add_argument('-m', '--map', metavar='FILE', type=str,
+                        help='Symbol file written by --map (default: image with .map extension, if present)')
+
+    args = parser.parse_args()
+
+    if args.format is None:
+        args.format = imageformat(args.file)
+        if args.format is None:
+            parser.error(f'cannot determine image format of {args.file}')
+
+    if args.map is None and os.path.exists(os.path.splitext(args.file)[0] + '.map'):
+        args.map = os.path.splitext(args.file)[0] + '.map'
+
+    symbols = loadsymbols(args.map) if args.map is not None else None
+    asm = disassemble(loadimage(args.file, args.format), symbols=symbols)
+
+    if args.output != '-':
+        with open(args.output, 'w') as f:
+            f.write(asm)
+    else:
+        sys.stdout.write(asm)
+
+if __name__ == '__main__':
+    main()
@@ -1,67 +1,209 @@
 """Disassembler for ENG1448 16-bit processor
-   (c) 2020-2024 Wouter Caarls, PUC-Rio
+   (c) 2020-2025 Wouter Caarls, PUC-Rio
 """
 
+import re, array
+
 from .instructions import defs
 
 regs = [f'r{reg}' for reg in range(13)]
 regs[13:16] = ['fp',  'sp', 'pc']
 
+# Default section origins.
+ORIGIN = {'io': 0, 'code': 16, 'data': 4096}
+
+# push r12, which precedes a jump in a subroutine call.
+PUSH_R12 = 0x60EC
+
+_table = None
+
+def table():
+    """Returns the (mnemonic, encoding) of every instruction word, or None
+    for illegal words. The first matching encoding in defs is used."""
+    global _table
+    if _table is None:
+        _table = [None] * 65536
+        for mnemonic in reversed(list(defs)):
+            for (opcode, minor, operands) in reversed(defs[mnemonic]):
+                if opcode == '':
+                    continue
+                base = (int(opcode, 2) << (16-len(opcode))) | (int(minor, 2) if minor != '' else 0)
+                for k in range(1 << (16-len(opcode)-len(minor))):
+                    _table[base | (k << len(minor))] = (mnemonic, (opcode, minor, operands))
+    return _table
+
 class Disassembler():
     """Disassemble machine code back to assembly."""
     def __init__(self, map=None):
         self.map = map
 
     def process(self, inst, pc):
-        """Disassemble a single instruction, replacing addresses with labels if a memory map is available."""
-        for mnemonic in defs:
-            for (opcode, minor, operands) in defs[mnemonic]:
-                if opcode != '' and inst[:len(opcode)] == opcode and (minor == '' or inst[-len(minor):] == minor):
-                    dis = f'{mnemonic:4} '
-                    for i, o in enumerate(operands):
-                        istart = len(opcode)+4*i
-                        reg = int(inst[istart:istart+4], 2)
-
-                        if o == 'R':
-                            dis += f'{regs[reg]}, '
-                        elif o == 'A':
-                            dis += f'[{regs[reg]}], '
-                        elif o == '4':
-                            val = int(inst[istart:istart+4], 2)
-                            if mnemonic == 'ldr' or mnemonic == 'str':
-                                if val > 7:
-                                    # signed
-                                    val -= 16
-                                # Convert [addr], offset into [addr, offset]
-                                dis = dis[:-3] + f', {val}], '
-                            else:
-                                dis += f'{val}, '
-                        elif o == 'S':
-                            val = int(inst[istart:istart+4], 2)
-                            dir = ''
-                            if val > 7:
-                                dir = '-'
-                            dis += f'{dir}{(val&7) + 1}, '
-                        elif o == '8':
-                            val = int(inst[istart:istart+8], 2)
-                            dis += f'{val}, '
-                        elif o == 'B':
-                            val = int(inst[istart:istart+8], 2)
-                            if val > 127:
-                                val -= 256
-                            valabs = val+pc+1
-                            if self.map is not None and valabs in self.map['code']:
-                                dis += f"@{self.map['code'][valabs]}, "
-                            else:
-                                dis += f'{val}, '
-                        elif o == '2':
-                            val = int(inst[istart:istart+12], 2)
-                            if self.map is not None and val in self.map['code']:
-                                dis += f"@{self.map['code'][val]}, "
-                            else:
-                                dis += f'{val}, '
-                        else:
-                            ValueError(f'Illegal operand {o}')
-                    dis = dis[:-2]
-                    return mnemonic, dis
-        raise ValueError(f'Illegal instruction {inst}')
+        """Disassemble a single instruction word, replacing addresses with labels if a memory map is available."""
+        entry = table()[inst]
+        if entry is None:
+            raise ValueError(f'Illegal instruction {inst}')
+
+        mnemonic, (opcode, minor, operands) = entry
+        dis = f'{mnemonic:4} '
+        for i, o in enumerate(operands):
+            ishift = 12-len(opcode)-4*i
+            reg = (inst >> ishift) & 15
+
+            if o == 'R':
+                dis += f'{regs[reg]}, '
+            elif o == 'A':
+                dis += f'[{regs[reg]}], '
+            elif o == '4':
+                val = reg
+                if mnemonic == 'ldr' or mnemonic == 'str':
+                    if val > 7:
+                        # signed
+                        val -= 16
+                    # Convert [addr], offset into [addr, offset]
+                    dis = dis[:-3] + f', {val}], '
+                else:
+                    dis += f'{val}, '
+            elif o == 'S':
+                val = reg
+                dir = ''
+                if val > 7:
+                    dir = '-'
+                dis += f'{dir}{(val&7) + 1}, '
+            elif o == '8':
+                val = (inst >> (ishift-4)) & 255
+                dis += f'{val}, '
+            elif o == 'B':
+                val = (inst >> (ishift-4)) & 255
+                if val > 127:
+                    val -= 256
+                valabs = val+pc+1
+                if self.map is not None and valabs in self.map['code']:
+                    dis += f"@{self.map['code'][valabs]}, "
+                else:
+                    # Branch targets are absolute in assembly.
+                    dis += f'{valabs}, '
+            elif o == '2':
+                val = (inst >> (ishift-8)) & 4095
+                if self.map is not None and val in self.map['code']:
+                    dis += f"@{self.map['code'][val]}, "
+                else:
+                    dis += f'{val}, '
+            else:
+                ValueError(f'Illegal operand {o}')
+        dis = dis[:-2]
+        return mnemonic, dis
+
+def target(inst, pc):
+    """Returns the target address of a branch or immediate jump, or None."""
+    entry = table()[inst]
+    if entry is None:
+        return None
+    operands = entry[1][2]
+    if operands == 'B':
+        val = inst & 255
+        return pc + 1 + (val - 256 if val > 127 else val)
+    elif operands == '2':
+        return inst & 4095
+    return None
+
+def flows(inst, prev):
+    """Whether execution may continue with the next word. Jumps after
+    push r12 are subroutine calls, which return to the next word."""
+    entry = table()[inst]
+    if entry is None:
+        return False
+    mnemonic, (opcode, minor, operands) = entry
+    if mnemonic in ['b', 'jmp', 'ret']:
+        jump = True
+    elif operands != '' and operands[0] == 'R' and mnemonic not in ['str', 'push']:
+        # Instruction writes the pc
+        jump = (inst >> (12-len(opcode))) & 15 == 15
+    else:
+        jump = False
+    return not jump or (prev == PUSH_R12 and mnemonic != 'ret')
+
+def loadsymbols(file):
+    """Loads the label addresses from a map file written by --map."""
+    symbols = {}
+    pattern = re.compile(r'(\S+)\s+(\d+)\s+(io|code|data)\s+\d+\s*$')
+    with open(file, 'r') as f:
+        for line in f:
+            m = pattern.match(line)
+            if m:
+                symbols[m.group(1)] = int(m.group(2))
+    return symbols
+
+def disassemble(image, origin=ORIGIN, symbols=None):
+    """Disassembles a memory image starting at address 0 into assembly that
+    reassembles to the same image. Code is recovered by following the
+    control flow from the start of the code section and from symbols in
+    it; other words are emitted as data. Branch and jump targets that are
+    not symbols get synthesized labels."""
+    image = array.array('H', image)
+    sections = sorted(origin, key=lambda s: origin[s])
+    bounds = {}
+    for i, s in enumerate(sections):
+        end = origin[sections[i+1]] if i < len(sections)-1 else len(image)
+        if origin[s] < len(image):
+            bounds[s] = (origin[s], min(end, len(image)))
+    code = bounds.get('code', (0, 0))
+
+    labels = {}
+    for name, addr in (symbols or {}).items():
+        labels.setdefault(addr, []).append(name)
+
+    # Follow control flow
+    reachable = bytearray(len(image))
+    work = [a for a in [code[0]] + list(labels) if code[0] <= a < code[1]]
+    while work:
+        pc = work.pop()
+        while code[0] <= pc < code[1] and not reachable[pc]:
+            reachable[pc] = 1
+            inst = image[pc]
+            if table()[inst] is None:
+                reachable[pc] = 0
+                break
+            t = target(inst, pc)
+            if t is not None:
+                if not t in labels:
+                    labels[t] = [f'l{t}']
+                work.append(t)
+            if not flows(inst, image[pc-1] if pc > 0 else 0):
+                break
+            pc += 1
+
+    # Only label addresses that are emitted
+    labels = {a: n for a, n in labels.items() if any(b[0] <= a < b[1] for b in bounds.values())}
+    dis = Disassembler({'code': {a: n[0] for a, n in labels.items()}})
+
+    lines = []
+    last = max(bounds, key=lambda s: bounds[s][0], default=None)
+    for s, (start, end) in bounds.items():
+        if s != last:
+            # Trailing zeros only need to be emitted to keep the image size
+            while end > start and image[end-1] == 0 and not reachable[end-1] and not end-1 in labels:
+                end -= 1
+            if end == start:
+                continue
+        lines.append(f'.section {s}')
+        a = start
+        while a < end:
+            for n in labels.get(a, []):
+                lines.append(f'{n}:')
+            if reachable[a]:
+                lines.append(f'        {dis.process(image[a], a)[1]:24} ; {a}')
+                a += 1
+            elif image[a] == 0:
+                # Skip zeros up to the next label or nonzero word
+                b = a + 1
+                while b < end and image[b] == 0 and not reachable[b] and not b in labels:
+                    b += 1
+                if b - a > 1:
+                    lines.append(f'        .org {b - start}')
+                else:
+                    lines.append(f'        {".dw 0":24} ; {a}')
+                a = b
+            else:
+                lines.append(f'        {".dw " + str(image[a]):24} ; {a}')
+                a += 1
+    return '\n'.join(lines) + '\n'
@@ -1,43 +1,49 @@
-"""ASM and VHDL emitter for ENG1448 16-bit processor
-   (c) 2020-2024 Wouter Caarls, PUC-Rio
+"""ASM and memory image emitter for ENG1448 16-bit processor
+   (c) 2020-2025 Wouter Caarls, PUC-Rio
 """
 
-# TODO: io section
+import os, io, sys, array, itertools
 
-import os
+from .ppci.format.hexfile import HexFile
+
+# Number of words in the VHDL RAM.
+DEPTH = 8192
 
 def emitasmsection(section, f):
-    """Emit assembly for a section."""
+    """Emit assembly for a section's source lines."""
     addr = 0
     skipped = False
     for c in section:
-        if c[1] == '':
+        if c == '':
             skipped = True
         else:
             if skipped == True:
                 print(f'.org {addr}', file=f)
                 skipped = False
-            print(c[1], file=f)
+            print(c, file=f)
         addr += 1
 
 
-def emitasm(mem, f):
+def emitasm(meta, f):
     """Emit assembly for all sections."""
     print('.section io', file=f)
-    emitasmsection(mem['io'], f)
+    emitasmsection(meta['io'], f)
     print('.section code', file=f)
-    emitasmsection(mem['code'], f)
+    emitasmsection(meta['code'], f)
     print('.section data', file=f)
-    emitasmsection(mem['data'], f)
+    emitasmsection(meta['data'], f)
 
-def emitarray(section, f, origin):
+def emitarray(section, f, origin, meta=None):
     """Emit a VHDL array for a section."""
-    for l, c in enumerate(section):
-        if c[0] != '0000000000000000' or c[1] != '':
-            print(f"    {origin+l:4} => \"{c[0]}\", -- {c[1]}", file=f)
+    if meta is None:
+        meta = itertools.repeat('')
+    f.writelines(f"    {origin+l:4} => \"{w:016b}\", -- {c}\n"
+                 for l, (w, c) in enumerate(zip(section, meta)) if w != 0 or c != '')
 
-def emitvhdl(mem, f, origin):
+def emitvhdl(mem, f, origin, meta=None):
     """Emit VHDL for all  sections."""
+    if meta is None:
+        meta = {}
     if f.name != '<stdout>':
         pkg = os.path.splitext(os.path.basename(f.name))[0]
         print(
@@ -53,10 +59,106 @@ package {pkg} is
         pkg = ''
         print(f"""  signal ram: ram_t := (
 """, file=f, end='')
-    emitarray(mem['io'], f, origin['io'])
-    emitarray(mem['code'], f, origin['code'])
-    emitarray(mem['data'], f, origin['data'])
+    emitarray(mem['io'], f, origin['io'], meta.get('io'))
+    emitarray(mem['code'], f, origin['code'], meta.get('code'))
+    emitarray(mem['data'], f, origin['data'], meta.get('data'))
     print("  others => (others => '0'));", file=f)
 
     if pkg != '':
         print(f'end package {pkg};', file=f)
+
+def flatten(mem, origin):
+    """Places all sections in a single image starting at address 0."""
+    end = max([origin[s] + len(mem[s]) for s in mem])
+    image = array.array('H', bytes(2*end))
+    for s in mem:
+        image[origin[s]:origin[s]+len(mem[s])] = array.array('H', mem[s])
+    return image
+
+def emitraw(mem, f, origin, meta=None):
+    """Emit raw little-endian words to a binary file."""
+    image = flatten(mem, origin)
+    if sys.byteorder == 'big':
+        image.byteswap()
+    f.write(image.tobytes())
+
+def emithex(mem, f, origin, meta=None):
+    """Emit Intel HEX with little-endian words at byte addresses."""
+    hf = HexFile()
+    for s in mem:
+        if len(mem[s]) > 0:
+            data = array.array('H', mem[s])
+            if sys.byteorder == 'big':
+                data.byteswap()
+            hf.add_region(2*origin[s], data.tobytes())
+    buf = io.StringIO()
+    hf.save(buf)
+    f.write(buf.getvalue())
+
+def emitcoe(mem, f, origin, meta=None):
+    """Emit a Xilinx coefficient file."""
+    image = flatten(mem, origin)
+    f.write('memory_initialization_radix=16;\nmemory_initialization_vector=\n')
+    f.writelines(f'{w:04x},\n' for w in image[:-1])
+    f.write(f'{image[-1]:04x};\n' if len(image) > 0 else ';\n')
+
+def emitmif(mem, f, origin, meta=None):
+    """Emit an Altera memory initialization file."""
+    image = flatten(mem, origin)
+    depth = max(DEPTH, len(image))
+    f.write(f'DEPTH = {depth};\nWIDTH = 16;\nADDRESS_RADIX = HEX;\nDATA_RADIX = HEX;\nCONTENT\nBEGIN\n')
+    f.writelines(f'{a:04x} : {w:04x};\n' for a, w in enumerate(image))
+    if len(image) < depth:
+        f.write(f'[{len(image):04x}..{depth-1:04x}] : 0000;\n')
+    f.write('END;\n')
+
+def emitreadmemh(mem, f, origin, meta=None):
+    """Emit a hexadecimal memory file for Verilog's $readmemh."""
+    for s in mem:
+        if len(mem[s]) > 0:
+            f.write(f'@{origin[s]:04x}\n')
+            f.writelines(f'{w:04x}\n' for w in mem[s])
+
+def emitmap(mem, f, origin, labels, sections, meta=None):
+    """Emit a map of section utilization and label addresses. Sections
+    extend to the next section origin, and the last to the end of the RAM,
+    which it shares with the stack. Words skipped by .org count as free."""
+    f.write('Section  Start   End  Used  Free  Largest gap\n')
+    for s in sorted(mem, key=lambda s: origin[s]):
+        end = min([origin[t] for t in mem if origin[t] > origin[s]], default=DEPTH)
+        used, gap, run = 0, 0, 0
+        for l in range(len(mem[s])):
+            if mem[s][l] != 0 or meta is None or meta[s][l] != '':
+                used += 1
+                run = 0
+            else:
+                run += 1
+                gap = max(gap, run)
+        gap = max(gap, run + end - origin[s] - len(mem[s]))
+        f.write(f'{s:7} {origin[s]:6} {end:5} {used:5} {end-origin[s]-used:5} {gap:12}\n')
+
+    # Labels extend to the next label in the same section.
+    width = max([len(l) for l in labels] + [5])
+    f.write(f'\n{"Label":{width}}  Address  Section  Size\n')
+    ordered = sorted(labels, key=lambda l: (sections[l] is None, labels[l]))
+    for i, l in enumerate(ordered):
+        s = sections[l]
+        if s is None:
+            f.write(f'{l:{width}}  {labels[l]:7}  {"equ":7}     -\n')
+            continue
+        end = origin[s] + len(mem[s])
+        for n in ordered[i+1:]:
+            if sections[n] == s and labels[n] > labels[l]:
+                end = labels[n]
+                break
+        f.write(f'{l:{width}}  {labels[l]:7}  {s:7} {end-labels[l]:5}\n')
+
+def emitdeps(target, deps, f):
+    """Emit a Makefile rule making target depend on the files in deps."""
+    escape = lambda p: p.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+    deps = list(dict.fromkeys(deps))
+    f.write(escape(target) + ':' + ''.join([' \\\n ' + escape(d) for d in deps]) + '\n')
+
+# Memory image emitters by format. The raw emitter requires a binary file.
+emitters = {'vhdl': emitvhdl, 'raw': emitraw, 'hex': emithex,
+            'coe': emitcoe, 'mif': emitmif, 'readmemh': emitreadmemh}
@@ -0,0 +1,137 @@
+"""Memory image loader for ENG1448 16-bit processor
+   (c) 2020-2025 Wouter Caarls, PUC-Rio
+"""
+
+import os, re, sys, array, mmap
+
+from .ppci.format.hexfile import HexFile
+
+# File extensions of supported memory image formats.
+formats = {'.bin': 'raw', '.raw': 'raw',
+           '.hex': 'hex', '.ihex': 'hex',
+           '.vhd': 'vhdl', '.vhdl': 'vhdl',
+           '.coe': 'coe', '.mif': 'mif', '.mem': 'readmemh'}
+
+def imageformat(file):
+    """Returns the image format of a file based on its extension, or None
+    if it is not a memory image."""
+    return formats.get(os.path.splitext(file)[1].lower())
+
+def loadraw(file):
+    """Maps a raw file of little-endian words into memory."""
+    with open(file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < 2:
+            return array.array('H')
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    words = memoryview(mm)[:len(mm)//2*2].cast('H')
+    if sys.byteorder == 'big':
+        words = array.array('H', words)
+        words.byteswap()
+    return words
+
+def loadhex(file):
+    """Loads an Intel HEX file of little-endian words at byte addresses."""
+    with open(file, 'r') as f:
+        hf = HexFile.load(f)
+
+    data = bytearray()
+    for region in hf.regions:
+        if region.address & 1 or len(region.data) & 1:
+            raise ValueError(f'{file}: Region {region} is not word-aligned')
+        if region.end_address > len(data):
+            data.extend(bytes(region.end_address - len(data)))
+        data[region.address:region.end_address] = region.data
+
+    words = array.array('H', data)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+def _store(words, addr, value):
+    """Stores a word, growing the image as needed."""
+    if addr >= len(words):
+        words.extend([0] * (addr + 1 - len(words)))
+    words[addr] = value
+
+def loadvhdl(file):
+    """Loads the initialization array of a VHDL package written by emitvhdl."""
+    words = array.array('H')
+    pattern = re.compile(r'\s*(\d+)\s*=>\s*"([01]{16})"')
+    with open(file, 'r') as f:
+        for line in f:
+            m = pattern.match(line)
+            if m:
+                _store(words, int(m.group(1)), int(m.group(2), 2))
+    return words
+
+def loadcoe(file):
+    """Loads the initialization vector of a Xilinx coefficient file."""
+    with open(file, 'r') as f:
+        text = re.sub(r';.*', ';', f.read())
+    radix = re.search(r'memory_initialization_radix\s*=\s*(\d+)', text, re.I)
+    vector = re.search(r'memory_initialization_vector\s*=([^;]*)', text, re.I)
+    if vector is None:
+        raise ValueError(f'{file}: Missing memory_initialization_vector')
+    radix = int(radix.group(1)) if radix else 10
+    return array.array('H', [int(v, radix) for v in re.split(r'[\s,]+', vector.group(1)) if v])
+
+def loadmif(file):
+    """Loads the content of an Altera memory initialization file."""
+    radices = {'HEX': 16, 'DEC': 10, 'UNS': 10, 'OCT': 8, 'BIN': 2}
+    words = array.array('H')
+    with open(file, 'r') as f:
+        text = re.sub(r'--.*|%[^%]*%', '', f.read())
+    header, _, content = text.upper().partition('BEGIN')
+    aradix = re.search(r'ADDRESS_RADIX\s*=\s*(\w+)', header)
+    dradix = re.search(r'DATA_RADIX\s*=\s*(\w+)', header)
+    aradix = radices[aradix.group(1)] if aradix else 16
+    dradix = radices[dradix.group(1)] if dradix else 16
+    for entry in content.split(';'):
+        if ':' not in entry:
+            continue
+        addr, values = entry.split(':', 1)
+        values = [int(v, dradix) & 0xFFFF for v in values.split()]
+        addr = addr.strip()
+        if addr.startswith('['):
+            # Address range, filled with the given values in turn
+            start, end = [int(a, aradix) for a in addr[1:-1].split('..')]
+            for i, a in enumerate(range(start, end + 1)):
+                _store(words, a, values[i % len(values)])
+        else:
+            for i, v in enumerate(values):
+                _store(words, int(addr, aradix) + i, v)
+    return words
+
+def loadreadmemh(file):
+    """Loads a hexadecimal memory file for Verilog's $readmemh."""
+    words = array.array('H')
+    addr = 0
+    with open(file, 'r') as f:
+        text = re.sub(r'//.*|/\*.*?\*/', '', f.read(), flags=re.S)
+    for token in text.split():
+        if token[0] == '@':
+            addr = int(token[1:], 16)
+        else:
+            _store(words, addr, int(token.replace('_', ''), 16))
+            addr += 1
+    return words
+
+def load(file, format=None):
+    """Loads a memory image, returning its words starting at address 0."""
+    if format is None:
+        format = imageformat(file)
+
+    if format == 'raw':
+        return loadraw(file)
+    elif format == 'hex':
+        return loadhex(file)
+    elif format == 'vhdl':
+        return loadvhdl(file)
+    elif format == 'coe':
+        return loadcoe(file)
+    elif format == 'mif':
+        return loadmif(file)
+    elif format == 'readmemh':
+        return loadreadmemh(file)
+    else:
+        raise ValueError(f'{file}: Unknown memory image format {format}')
@@ -6,6 +6,7 @@ defs = {
         'mov':   [('1001',         '0000', 'RR'), # add d, s, 0
                   ('0000',             '', 'R8')],
         'movt':  [('0001',             '', 'R8')],
+        'ldi':   [('',                 '', 'R6')], # mov, or mov and movt
         'b':     [('00100000',         '', 'B')],
         'bz':    [('00100001',         '', 'B')],
         'beq':   [('00100001',         '', 'B')],
@@ -41,5 +42,6 @@ defs = {
         '.org':  [('',                 '', '6')],
         '.dw':   [('',                 '', '6')],
         '.section': [('',              '', 'X')],
+        '.global': [('',               '', 'X')],
         '.equ':  [('',                 '', 'X6')]
        }
@@ -180,9 +180,10 @@ def optimize(ir_module, level=0, reporter=None):
         ir_module (ppci.ir.Module): The ir module to optimize.
         level: The optimization level, 0 is default. Can be 0,1,2 or s
             0: No optimization
-            1: some optimization
-            2: more optimization
-            s: optimize for size
+            1: cheap passes, run once
+            2: all passes, run three times
+            s: optimize for size, runs the same passes as 2. Pass
+               opt="size" to the code generator as well.
         reporter: Report detailed log to this reporter
     """
     logger = logging.getLogger("optimize")
@@ -199,22 +200,29 @@ def optimize(ir_module, level=0, reporter=None):
     if level == "0":
         return
 
-    # TODO: differentiate between optimization levels!
-
-    # Optimization passes (bag of tricks) run them three times:
-    opt_passes = [
-        Mem2RegPromotor(),
-        RemoveAddZeroPass(),
-        ConstantFolder(),
-        CommonSubexpressionEliminationPass(),
-        TailCallOptimization(),
-        LoadAfterStorePass(),
-        DeleteUnusedInstructionsPass(),
-        CleanPass(),
-    ] * 3
-
-    if level == "3":
-        opt_passes.append(CJumpPass())
+    if level == "1":
+        # Cheap passes that remove most of the front-end overhead:
+        opt_passes = [
+            Mem2RegPromotor(),
+            RemoveAddZeroPass(),
+            ConstantFolder(),
+            DeleteUnusedInstructionsPass(),
+            CleanPass(),
+        ]
+    else:
+        # All passes, run three times such that they can enable each other.
+        # None of these increase code size, so -Os uses them as well:
+        opt_passes = [
+            Mem2RegPromotor(),
+            RemoveAddZeroPass(),
+            ConstantFolder(),
+            CJumpPass(),
+            CommonSubexpressionEliminationPass(),
+            TailCallOptimization(),
+            LoadAfterStorePass(),
+            DeleteUnusedInstructionsPass(),
+            CleanPass(),
+        ] * 3
 
     # Run the passes over the module:
     verify_module(ir_module)
@@ -2,6 +2,7 @@
 
 """
 
+from itertools import chain
 from .digraph import DiGraph, DiNode
 from .. import ir
 
@@ -28,7 +29,40 @@ def mod_to_call_graph(ir_module) -> CallGraph:
         for instruction in routine.get_instructions():
             if isinstance(instruction, (ir.FunctionCall, ir.ProcedureCall)):
                 routine2 = instruction.callee
-                n2 = node_map[routine2]
-                cg.add_edge(n1, n2)
+                if routine2 in node_map:  # Indirect calls have no node
+                    n2 = node_map[routine2]
+                    cg.add_edge(n1, n2)
 
     return cg
+
+
+def mod_to_reference_graph(ir_module):
+    """Create a graph of the functions, variables and externals of an
+    ir-module, with an edge wherever one calls, takes the address of, or
+    is initialized with another. Returns the graph and the node map."""
+    cg = CallGraph()
+
+    # Create graph nodes:
+    node_map = {}
+    for value in chain(
+        ir_module.functions, ir_module.variables, ir_module.externals
+    ):
+        node_map[value] = DiNode(cg)
+    names = {value.name: value for value in node_map}
+
+    # Add edges for values used by instructions:
+    for routine in ir_module.functions:
+        n1 = node_map[routine]
+        for instruction in routine.get_instructions():
+            for value in instruction.uses:
+                if value in node_map:
+                    cg.add_edge(n1, node_map[value])
+
+    # Add edges for labels in initial values:
+    for variable in ir_module.variables:
+        n1 = node_map[variable]
+        for part in variable.value or ():
+            if isinstance(part, tuple) and part[1] in names:
+                cg.add_edge(n1, node_map[names[part[1]]])
+
+    return cg, node_map
@@ -743,11 +743,13 @@ class Instruction:
         """
         # TODO: update reference
         # assert old in self._var_map.values()
-        for name in self._var_map:
-            if self._var_map[name] is old:
-                self.del_use(old)
+        # The same value can be used by more than one operand:
+        names = [n for n in self._var_map if self._var_map[n] is old]
+        if names:
+            self.del_use(old)
+            for name in names:
                 self._var_map[name] = new
-                self.add_use(new)
+            self.add_use(new)
 
     def remove_from_block(self):
         for use in list(self.uses):
@@ -1035,11 +1037,11 @@ class Phi(LocalValue):
     def replace_use(self, old, new):
         """ Replace old value reference by new value reference """
         assert old in self.inputs.values()
+        self.del_use(old)
         for inp in self.inputs:
-            if self.inputs[inp] == old:
-                self.del_use(old)
+            if self.inputs[inp] is old:
                 self.inputs[inp] = new
-                self.add_use(new)
+        self.add_use(new)
 
     def set_incoming(self, block, value):
         """ Set the value for the phi node when entering through block """
@@ -1050,7 +1052,7 @@ class Phi(LocalValue):
                 )
             )
         if block in self.inputs:
-            self.del_use(self.inputs[block])
+            self.del_incoming(block)
         self.inputs[block] = value
         self.add_use(value)
 
@@ -1061,7 +1063,9 @@ class Phi(LocalValue):
     def del_incoming(self, block):
         """ Remove incoming branch from this phi node and delete the usage """
         value = self.inputs.pop(block)
-        self.del_use(value)
+        # The same value can come in through more than one block:
+        if value not in self.inputs.values():
+            self.del_use(value)
 
 
 class Alloc(LocalValue):
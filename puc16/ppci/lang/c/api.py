@@ -16,13 +16,17 @@ def preprocess(f, output_file, coptions=None):
     CTokenPrinter().dump(tokens, file=output_file)
 
 
-def c_to_ir(source: io.TextIOBase, march, coptions=None, reporter=None):
+def c_to_ir(
+    source: io.TextIOBase, march, coptions=None, reporter=None, dependencies=None
+):
     """C to ir translation.
 
     Args:
         source (file-like object): The C source to compile.
         march (str): The targetted architecture.
         coptions: C specific compilation options.
+        dependencies: If a list, the paths of all included files are
+            appended to it.
 
     Returns:
         An :class:`ppci.ir.Module`.
@@ -45,4 +49,6 @@ def c_to_ir(source: io.TextIOBase, march, coptions=None, reporter=None):
         filename = None
 
     ir_module = cbuilder.build(source, filename, reporter=reporter)
+    if dependencies is not None:
+        dependencies.extend(cbuilder.dependencies)
     return ir_module
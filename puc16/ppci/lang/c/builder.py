@@ -30,6 +30,7 @@ class CBuilder:
 
         context = CContext(self.coptions, self.arch_info)
         compile_unit = _parse(src, filename, context)
+        self.dependencies = context.dependencies
 
         if reporter:
             f = io.StringIO()
@@ -65,6 +66,7 @@ def create_ast(src, arch_info, filename="<snippet>", coptions=None):
 
 def _parse(src, filename, context):
     preprocessor = CPreProcessor(context.coptions)
+    context.dependencies = preprocessor.dependencies
     tokens = preprocessor.process_file(src, filename)
     semantics = CSemantics(context)
     parser = CParser(context.coptions, semantics)
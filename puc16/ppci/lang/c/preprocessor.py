@@ -36,6 +36,7 @@ class CPreProcessor:
         self.verbose = coptions["verbose"]
         self.macros = {}  # A mapping of macros
         self.files = []  # Stack of included files.
+        self.dependencies = []  # Paths of all included files.
         self.counter = 0  # For the __COUNTER__ macro
         self._int_type = types.BasicType(types.BasicType.INT)
 
@@ -248,6 +249,7 @@ class CPreProcessor:
         self.logger.debug("Including %s", full_path)
         source_file = SourceFile(full_path)
         self.files[-1].dependencies.append(source_file)
+        self.dependencies.append(full_path)
         with open(full_path, "r") as f:
             for token in self.process_file(f, full_path):
                 yield token
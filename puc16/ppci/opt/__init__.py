@@ -2,6 +2,7 @@ from .clean import CleanPass
 from .mem2reg import Mem2RegPromotor
 from .cse import CommonSubexpressionEliminationPass
 from .constantfolding import ConstantFolder
+from .deadsymbols import DeadSymbolEliminationPass
 from .load_after_store import LoadAfterStorePass
 from .transform import RemoveAddZeroPass
 from .transform import DeleteUnusedInstructionsPass
@@ -16,6 +17,7 @@ __all__ = [
     "CleanPass",
     "CommonSubexpressionEliminationPass",
     "ConstantFolder",
+    "DeadSymbolEliminationPass",
     "DeleteUnusedInstructionsPass",
     "LoadAfterStorePass",
     "Mem2RegPromotor",
@@ -4,6 +4,27 @@ from .. import ir
 
 
 class CJumpPass(InstructionPass):
+    """Replace conditional jumps on two constants by a jump to the taken
+    branch, and remove the blocks that are no longer reachable.
+    """
+
+    def on_function(self, function):
+        super().on_function(function)
+        function.delete_unreachable()
+        self.remove_single_phis(function)
+
+    def remove_single_phis(self, function):
+        """Replace phis that are left with a single incoming branch by
+        their value. Otherwise, a later pass that glues the block to its
+        predecessor would leave a phi referring to the glued block."""
+        for block in function:
+            for phi in block.phis:
+                if len(phi.inputs) == 1:
+                    (value,) = phi.inputs.values()
+                    phi.replace_by(value)
+                    block.remove_instruction(phi)
+                    phi.delete()
+
     def on_instruction(self, instruction):
         if (
             isinstance(instruction, ir.CJump)
@@ -22,9 +43,14 @@ class CJumpPass(InstructionPass):
             }
             if mp[instruction.cond](a, b):
                 label = instruction.lab_yes
+                dropped = instruction.lab_no
             else:
                 label = instruction.lab_no
+                dropped = instruction.lab_yes
             block = instruction.block
+            if dropped is not label:
+                for phi in dropped.phis:
+                    phi.del_incoming(block)
             block.remove_instruction(instruction)
             block.add_instruction(ir.Jump(label))
             instruction.delete()
@@ -49,12 +49,17 @@ class CleanPass(FunctionPass):
             if block in predecessors:
                 continue
 
+            # Do not remove if a predecessor also branches to the target
+            # directly, since its phis would merge both incoming values:
+            tgt = block.last_instruction.target
+            if tgt.phis and any(tgt in pred.successors for pred in predecessors):
+                continue
+
             # Update successor incoming blocks:
             for successor in successors:
                 successor.replace_incoming(block, predecessors)
 
             # Change the target of predecessors:
-            tgt = block.last_instruction.target
             for pred in predecessors:
                 pred.change_target(block, tgt)
 
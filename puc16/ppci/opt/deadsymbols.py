@@ -0,0 +1,51 @@
+""" Remove functions and variables that are never used.
+
+"""
+
+from .. import ir
+from ..graph.callgraph import mod_to_reference_graph
+from .transform import ModulePass
+
+
+class DeadSymbolEliminationPass(ModulePass):
+    """Remove the functions and variables that cannot be reached from the
+    symbols named in roots, through calls, address references or initial
+    values. If roots is None, all global symbols are roots, such that only
+    unused static symbols are removed.
+    """
+
+    def __init__(self, roots=None):
+        super().__init__()
+        self.roots = roots
+
+    def run(self, ir_module):
+        cg, node_map = mod_to_reference_graph(ir_module)
+
+        if self.roots is None:
+            roots = [
+                v for v in node_map if v.binding == ir.Binding.GLOBAL
+            ]
+        else:
+            roots = [v for v in node_map if v.name in self.roots]
+
+        # Mark everything reachable from the roots:
+        live = set()
+        worklist = [node_map[v] for v in roots]
+        while worklist:
+            node = worklist.pop()
+            if node not in live:
+                live.add(node)
+                worklist.extend(node.successors)
+
+        for function in list(ir_module.functions):
+            if node_map[function] not in live:
+                self.logger.debug("Removing unused function %s", function.name)
+                for instruction in function.get_instructions():
+                    for value in list(instruction.uses):
+                        instruction.del_use(value)
+                ir_module.functions.remove(function)
+
+        for variable in list(ir_module.variables):
+            if node_map[variable] not in live:
+                self.logger.debug("Removing unused variable %s", variable.name)
+                ir_module.variables.remove(variable)
@@ -4,6 +4,10 @@
 
 import array
 import copy
+import mmap
+import os
+import struct
+import sys
 import time
 from .disassembler import Disassembler
 from .font import font8x8_basic
@@ -12,6 +16,7 @@ MAXVAL = 65535
 NEGBIT = 32768
 CARRYBIT = 65536
 CODESTART = 16
+DATASTART = 4096
 STACKSTART = 8191
 
 VRAM = 8*1024
@@ -22,6 +27,10 @@ MEMSIZE = 16384
 
 VGA_CTRL_REG = 15
 
+# Memory regions (name, start, end). The stack lives at the top of the data region.
+REGIONS = [('io', 0, CODESTART), ('code', CODESTART, DATASTART), ('data', DATASTART, VRAM),
+           ('vram', VRAM, CRAM), ('cram', CRAM, PRAM), ('pram', PRAM, MEMSIZE)]
+
 class Screen:
     def __init__(self):
         global pygame
@@ -77,8 +86,14 @@ class Screen:
     def close(self):
         pygame.quit()
 
+STATE_MAGIC = b'P16ST\x00\x01\x00'
+STATE_HEADER = struct.Struct('<8s16iI4?') # magic, registers, steps, zf, cf, nf, vf
+
 class State:
-    """Machine state for simulator."""
+    """Machine state for simulator.
+
+       mem is either a dictionary of assembled sections, placed according
+       to origin, or a memory image of words starting at address 0."""
     def __init__(self, mem=None,origin=None):
         self.regs = [0 for i in range(16)]
 
@@ -97,11 +112,14 @@ class State:
         # Set palette index 0 subindex 1 to white
         self.mem[PRAM+1] = 65535
 
-        if mem:
+        if isinstance(mem, dict):
             for s in mem:
                 o = origin[s]
-                for i, c in enumerate(mem[s]):
-                    self.mem[o+i] = int(c[0], 2)
+                memoryview(self.mem)[o:o+len(mem[s])] = memoryview(mem[s])
+        elif mem is not None:
+            # Memory image starting at address 0
+            n = min(len(mem), MEMSIZE)
+            memoryview(self.mem)[:n] = memoryview(mem)[:n]
 
         self.regs[14] = STACKSTART
         self.regs[15] = CODESTART
@@ -109,6 +127,7 @@ class State:
         self.carry = False
         self.negative = False
         self.overflow = False
+        self.steps = 0
 
     def diff(self, state):
         """Calculates difference between this state and another."""
@@ -137,6 +156,38 @@ class State:
             d = d[2:]
         return d
 
+    def save(self, file):
+        """Saves state to file. Memory is stored as raw little-endian words."""
+        mem = self.mem
+        if sys.byteorder == 'big':
+            mem = array.array('H', mem)
+            mem.byteswap()
+        with open(file, 'wb') as f:
+            f.write(STATE_HEADER.pack(STATE_MAGIC, *self.regs, self.steps,
+                                      self.zero, self.carry, self.negative, self.overflow))
+            f.write(mem)
+
+    @staticmethod
+    def load(file):
+        """Loads state from file written by save()."""
+        state = State()
+        with open(file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size != STATE_HEADER.size + 2*MEMSIZE:
+                raise ValueError(f'{file}: Not a simulator state file')
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with mm:
+            header = STATE_HEADER.unpack_from(mm)
+            if header[0] != STATE_MAGIC:
+                raise ValueError(f'{file}: Not a simulator state file')
+            state.regs = list(header[1:17])
+            state.steps = header[17]
+            state.zero, state.carry, state.negative, state.overflow = header[18:22]
+            with memoryview(mm) as view:
+                memoryview(state.mem)[:] = view[STATE_HEADER.size:].cast('H')
+        if sys.byteorder == 'big':
+            state.mem.byteswap()
+        return state
+
     def __str__(self):
         s = ''
         for i in range(14):
@@ -145,30 +196,160 @@ class State:
 
         return s
 
+PUSH_R12 = 0x60EC  # push r12
+POP_PC = 0x7FE0    # pop pc
+
 class Simulator:
     """Simulates machine code."""
     def __init__(self, map = None):
         self.disassembler = Disassembler(map)
+        self.clear_hooks()
+
+    def clear_hooks(self):
+        """Removes all registered hooks."""
+        self.hooks = {'step': [], 'mem_read': [], 'mem_write': [], 'io': [],
+                      'call': [], 'ret': [], 'halt': []}
+        self.halted = False
+        self.step = self._step
+
+    def _hook(self, event, hook):
+        """Registers a hook and switches to the hooked step function."""
+        self.hooks[event].append(hook)
+        self.step = self._step_hooked
+        return hook
+
+    def on_step(self, callback):
+        """Calls callback(state) before every instruction."""
+        return self._hook('step', callback)
+
+    def on_mem_read(self, callback, start=0, end=MEMSIZE):
+        """Calls callback(state, addr, value) after every memory read
+        (ldr, pop) from an address in [start, end)."""
+        return self._hook('mem_read', (start, end, callback))
+
+    def on_mem_write(self, callback, start=0, end=MEMSIZE):
+        """Calls callback(state, addr, value) after every memory write
+        (str, push) to an address in [start, end)."""
+        return self._hook('mem_write', (start, end, callback))
+
+    def on_io(self, callback):
+        """Calls callback(state, addr, value, write) for every ldr or str
+        to the io section. Reads are reported before the instruction
+        executes, with value None; if callback returns a value, it is
+        loaded instead of reading the device."""
+        return self._hook('io', callback)
+
+    def on_call(self, callback):
+        """Calls callback(state, target, retaddr) after every subroutine call,
+        i.e. a jump or branch directly preceded by push r12."""
+        return self._hook('call', callback)
+
+    def on_ret(self, callback):
+        """Calls callback(state, retaddr) after every return (pop pc)."""
+        return self._hook('ret', callback)
+
+    def on_halt(self, callback):
+        """Calls callback(state) when the program enters an infinite
+        single-instruction loop."""
+        return self._hook('halt', callback)
+
+    def _step(self, state):
+        """Returns machine state after executing the current instruction."""
+        return self.execute(state.mem[state.regs[15]], state)
+
+    def _step_hooked(self, state):
+        """Returns machine state after executing the current instruction,
+        calling registered hooks."""
+        hooks = self.hooks
+        for callback in hooks['step']:
+            callback(state)
+
+        pc = state.regs[15]
+        inst = state.mem[pc]
+        opcode = inst >> 12
+        r1 = (inst >> 8) & 15
+        r2 = (inst >> 4) & 15
+        r3 = inst & 15
+
+        # Determine memory access
+        read, write = None, None
+        if opcode == 4 or opcode == 5:
+            addr = (state.regs[r2] + (r3 - 16 if r3 > 7 else r3))&MAXVAL
+            if opcode == 4:
+                read = addr
+            else:
+                write, value = addr, state.regs[r1]
+        elif opcode == 6:
+            write, value = state.regs[14], state.regs[r3]
+        elif opcode == 7:
+            read = (state.regs[14]+1)%MEMSIZE
+
+        next = None
+        if read is not None and opcode == 4 and read < CODESTART:
+            for callback in hooks['io']:
+                value = callback(state, read, None, False)
+                if value is not None:
+                    # Device read overridden by hook
+                    next = copy.deepcopy(state)
+                    next.regs[15] += 1
+                    next.steps += 1
+                    next.regs[r1] = value&MAXVAL
+                    break
+
+        if next is None:
+            next = self.execute(inst, state)
+
+        if read is not None:
+            value = next.regs[r1]
+            for start, end, callback in hooks['mem_read']:
+                if start <= read < end:
+                    callback(next, read, value)
+        elif write is not None:
+            for start, end, callback in hooks['mem_write']:
+                if start <= write < end:
+                    callback(next, write, value)
+            if opcode == 5 and write < CODESTART:
+                for callback in hooks['io']:
+                    callback(next, write, value, True)
+
+        if (opcode == 3 or (inst & 0xFF00) == 0x2000 or (inst & 0xFF0F) == 0x9F00) and state.mem[(pc-1)%MEMSIZE] == PUSH_R12:
+            # jmp, b or mov pc, rX after push r12
+            for callback in hooks['call']:
+                callback(next, next.regs[15], state.mem[(state.regs[14]+1)%MEMSIZE])
+        elif inst == POP_PC:
+            for callback in hooks['ret']:
+                callback(next, next.regs[15])
+
+        if next.regs[15] == pc:
+            if not self.halted:
+                self.halted = True
+                for callback in hooks['halt']:
+                    callback(next)
+        else:
+            self.halted = False
 
-    def execute(self, bin, state):
-        """Returns machine state after executing instruction."""
+        return next
+
+    def execute(self, inst, state):
+        """Returns machine state after executing instruction word."""
         # Disassemble instruction
-        m, dis = self.disassembler.process(bin, state.regs[15])
-
-        opcode = bin[0:4]
-        r1 = int(bin[4:8], 2)
-        r2 = int(bin[8:12], 2)
-        r3 = int(bin[12:16], 2)
-        c4i = int(bin[12]*12 + bin[12:16], 2)
-        c4 = int(bin[12:16], 2)
-        c8i = int(bin[8]*8 + bin[8:16], 2)
-        c8 = int(bin[8:16], 2)
-        c12 = int(bin[4:16], 2)
+        m, dis = self.disassembler.process(inst, state.regs[15])
+
+        opcode = inst >> 12
+        r1 = (inst >> 8) & 15
+        r2 = (inst >> 4) & 15
+        r3 = inst & 15
+        c4i = r3 - 16 if r3 & 8 else r3
+        c4 = r3
+        c8 = inst & 255
+        c8i = c8 - 256 if c8 & 128 else c8
+        c12 = inst & 4095
         next = copy.deepcopy(state)
         next.regs[15] += 1
+        next.steps += 1
 
         addr = (next.regs[r2] + c4i)&MAXVAL
-        if m == 'shft' or ((m == 'add' or m == 'sub') and opcode[3] == '1'):
+        if m == 'shft' or ((m == 'add' or m == 'sub') and opcode & 1):
             val = c4
         else:
             val = state.regs[r3]
@@ -191,7 +372,7 @@ class Simulator:
             else:
                 next.mem[addr%MEMSIZE] = next.regs[r1]
         elif m == 'mov':
-            if opcode == '0000':
+            if opcode == 0:
                 next.regs[r1] = c8
             else:
                 next.regs[r1] = next.regs[r2]
@@ -263,19 +444,29 @@ class Simulator:
    c       Execute continuously until halted.
    p       Print current state.
    q       Exit simulator.
+   w f     Save state to file f.
+   l f     Load state from file f.
    rx      Print contents of register x.
    rx = y  Set register x to value y.
    [a]     Print contents of memory address a.
    [a] = y Set memory address a to value y.
 """)
 
+    def _initial(self, mem, origin):
+        """Returns initial state for a simulation."""
+        self.halted = False
+        if isinstance(mem, State):
+            return copy.deepcopy(mem)
+        return State(mem, origin)
+
     def process(self, mem, origin, vis=False):
-        """Simulate machine code."""
+        """Simulate machine code. mem may also be a State to resume from.
+        The final state is available as self.state."""
         screen = None
         if vis:
             screen = Screen()
 
-        state = State(mem, origin)
+        state = self._initial(mem, origin)
 
         breakpoints = []
         quiet = False
@@ -283,20 +474,21 @@ class Simulator:
 
         while True:
             # Print current instruction
-            bin = format(state.mem[state.regs[15]], '016b')
+            inst = state.mem[state.regs[15]]
 
             if quiet:
                 if screen is not None and time.time() > lastvis + 1./60:
                     screen.draw(state)
                     lastvis = time.time()
 
-                next = self.execute(bin, state)
+                next = self.step(state)
                 if next.regs[15] == state.regs[15] or next.regs[15] in breakpoints:
                     quiet = False
                 state = next
                 continue
 
-            _, dis = self.disassembler.process(bin, state.regs[15])
+            _, dis = self.disassembler.process(inst, state.regs[15])
+            bin = format(inst, '016b')
             print(f'{state.regs[15]:3}: {bin[0:4]} {bin[4:8]} {bin[8:12]} {bin[12:16]} ({dis})')
 
             next = copy.deepcopy(state)
@@ -307,7 +499,7 @@ class Simulator:
             cmd = input('>> ').strip()
             if cmd == '' or cmd == 'n':
                 # Advance to next instruction
-                next = self.execute(bin, state)
+                next = self.step(state)
             elif cmd == 'c':
                 # Execute continuously
                 quiet = True
@@ -327,7 +519,20 @@ class Simulator:
                 print(state)
             elif cmd == 'q':
                 # Exit simulator
+                self.state = state
                 return
+            elif cmd[0] == 'w' and len(cmd) > 2:
+                # Save state
+                try:
+                    state.save(cmd[2:].strip())
+                except Exception as e:
+                    print(e)
+            elif cmd[0] == 'l' and len(cmd) > 2:
+                # Load state
+                try:
+                    next = State.load(cmd[2:].strip())
+                except Exception as e:
+                    print(e)
             elif cmd[0] == 'r':
                 # Set register
                 tokens = [t.strip() for t in cmd.split('=')]
@@ -373,11 +578,153 @@ class Simulator:
 
 
     def run(self, mem, origin, steps=1000):
-        """Simulate machine code for a set number of steps and return PC."""
-        state = State(mem, origin)
+        """Simulate machine code for a set number of steps and return PC.
+        mem may also be a State to resume from. The final state is available
+        as self.state."""
+        state = self._initial(mem, origin)
 
         for s in range(steps):
-            bin = format(state.mem[state.regs[15]], '016b')
-            state = copy.deepcopy(self.execute(bin, state))
+            state = self.step(state)
 
+        self.state = state
         return state.regs[15]
+
+class MemoryProfiler:
+    """Records memory access counts and stack usage during simulation."""
+    def __init__(self, sim):
+        self.reads = array.array('L', [0]) * MEMSIZE
+        self.writes = array.array('L', [0]) * MEMSIZE
+        self.stack_reads = 0
+        self.stack_writes = 0
+        self.min_sp = STACKSTART
+
+        sim.on_step(self._step)
+        sim.on_mem_read(self._read)
+        sim.on_mem_write(self._write)
+
+    def _step(self, state):
+        # State before the instruction, which covers all but the last one.
+        if state.regs[14] < self.min_sp:
+            self.min_sp = state.regs[14]
+
+    def _read(self, state, addr, value):
+        self.reads[addr] += 1
+        # After pop, sp points to the word just read.
+        if DATASTART <= state.regs[14] <= addr < VRAM:
+            self.stack_reads += 1
+
+    def _write(self, state, addr, value):
+        self.writes[addr] += 1
+        # State after the instruction, such that a push by the last
+        # instruction is counted as well.
+        if state.regs[14] < self.min_sp:
+            self.min_sp = state.regs[14]
+        # After push, sp points below the word just written.
+        if DATASTART <= state.regs[14] < addr < VRAM:
+            self.stack_writes += 1
+
+    def regions(self):
+        """Returns a dictionary of (reads, writes) per memory region."""
+        counts = {}
+        for name, start, end in REGIONS:
+            counts[name] = (sum(self.reads[start:end]), sum(self.writes[start:end]))
+            if name == 'data':
+                counts['stack'] = (self.stack_reads, self.stack_writes)
+                counts['data'] = (counts['data'][0] - self.stack_reads, counts['data'][1] - self.stack_writes)
+        return counts
+
+    def hot(self, n=10):
+        """Returns the n most accessed addresses as (addr, reads, writes)."""
+        addrs = sorted(range(MEMSIZE), key=lambda a: self.reads[a] + self.writes[a], reverse=True)
+        return [(a, self.reads[a], self.writes[a]) for a in addrs[:n] if self.reads[a] + self.writes[a] > 0]
+
+    def report(self, f=None, dataend=None):
+        """Prints memory usage report. If dataend is given, checks whether
+        the stack collided with the data section."""
+        print(f'Stack: {STACKSTART - self.min_sp} words used, lowest sp = {self.min_sp}', file=f)
+        if dataend is not None:
+            free = self.min_sp + 1 - dataend
+            if free < 0:
+                print(f'Stack collided with data section (ends at {dataend})', file=f)
+            else:
+                print(f'Free words between data and stack: {free}', file=f)
+        print('Region     reads    writes', file=f)
+        for name, (reads, writes) in self.regions().items():
+            print(f'{name:6} {reads:9} {writes:9}', file=f)
+        print('Hot addresses:', file=f)
+        for addr, reads, writes in self.hot():
+            print(f'  [{addr:5}] {reads:9} {writes:9}', file=f)
+
+IOLOG_MAGIC = b'P16IO\x00\x01\x00'
+IOLOG_RECORD = struct.Struct('<IHH') # step, address, value
+
+class IORecorder:
+    """Logs every io section read together with its step number."""
+    def __init__(self, sim, file):
+        self.f = open(file, 'wb')
+        self.f.write(IOLOG_MAGIC)
+
+        sim.on_mem_read(self._read, 0, CODESTART)
+
+    def _read(self, state, addr, value):
+        self.f.write(IOLOG_RECORD.pack(state.steps, addr, value))
+
+    def close(self):
+        self.f.close()
+
+class IOReplayer:
+    """Feeds io section reads from a log written by IORecorder.
+
+       Replay starts at the given step, such that a run resumed from a
+       saved state continues with the correct input."""
+    def __init__(self, sim, file, step=0):
+        with open(file, 'rb') as f:
+            data = f.read()
+        if data[:len(IOLOG_MAGIC)] != IOLOG_MAGIC:
+            raise ValueError(f'{file}: Not an I/O log')
+        self.log = IOLOG_RECORD.iter_unpack(memoryview(data)[len(IOLOG_MAGIC):])
+        self.next = next(self.log, None)
+        while self.next is not None and self.next[0] <= step:
+            self.next = next(self.log, None)
+
+        sim.on_io(self._io)
+
+    def _io(self, state, addr, value, write):
+        if write:
+            return None
+        # Reads are reported before the instruction executes.
+        current = state.steps + 1
+        if self.next is None:
+            raise RuntimeError(f'Step {current}: Read from [{addr}] beyond end of I/O log')
+        step, logaddr, value = self.next
+        if step != current or logaddr != addr:
+            raise RuntimeError(f'Step {current}: Read from [{addr}] diverges from I/O log (step {step}, [{logaddr}])')
+        self.next = next(self.log, None)
+        return value
+
+def simulate(args, mem, origin):
+    """Simulate according to command line arguments."""
+    sim = Simulator()
+    if args.load_state:
+        mem = State.load(args.load_state)
+    if args.profile:
+        profiler = MemoryProfiler(sim)
+    if args.record:
+        recorder = IORecorder(sim, args.record)
+    if args.replay:
+        IOReplayer(sim, args.replay, mem.steps if isinstance(mem, State) else 0)
+    if args.simulate:
+        sim.process(mem, origin, args.vga)
+    else:
+        pc = sim.run(mem, origin, 1000)
+    if args.record:
+        recorder.close()
+    if args.save_state:
+        sim.state.save(args.save_state)
+    if args.profile:
+        if isinstance(mem, dict):
+            profiler.report(dataend=origin['data'] + len(mem['data']))
+        else:
+            profiler.report()
+    if not args.simulate and pc != args.test:
+        raise RuntimeError('PC after 1000 steps is ' + str(pc) + ', expected ' + str(args.test))
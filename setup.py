@@ -28,7 +28,8 @@ setup(name='puc16',
       package_data={'': ['*.grammar']},
       entry_points = {
         'console_scripts': ['as-puc16=puc16.asm:main',
-                            'cc-puc16=puc16.cc:main']
+                            'cc-puc16=puc16.cc:main',
+                            'dis-puc16=puc16.dis:main']
       },
       extras_require={
         'vga': ['pygame', 'numpy']